@@ -0,0 +1,68 @@
+"""
+Throughput of GATT notifications written to an AcquireNotify socket,
+with a socketpair standing in for bluez.
+
+  python3 bench_gatt.py [values] [value size] [mtu]
+"""
+
+import socket
+import sys
+import threading
+import time
+
+from blus.gatt import Notifier
+
+
+def drain(sock, counts):
+    while True:
+        packet = sock.recv(4096)
+        if not packet:
+            return
+        counts[0] += 1
+        counts[1] += len(packet)
+
+
+def run(values, size, mtu, coalesce, batch=100):
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    ours.setblocking(False)
+    counts = [0, 0]
+    reader = threading.Thread(target=drain, args=(theirs, counts))
+    reader.start()
+
+    notifier = Notifier(ours, mtu, coalesce)
+    value = bytes(size)
+    start = time.perf_counter()
+    for i in range(0, values, batch):
+        for _ in range(min(batch, values - i)):
+            notifier.queue(value)
+        while not notifier.flush():
+            time.sleep(0)
+    ours.shutdown(socket.SHUT_WR)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    ours.close()
+    theirs.close()
+
+    assert counts[1] == values * size
+    print(
+        "coalesce=%-5s %8d values/s %8d notifications/s %7.1f MB/s"
+        % (
+            coalesce,
+            values / elapsed,
+            counts[0] / elapsed,
+            counts[1] / elapsed / 1e6,
+        )
+    )
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:4]]
+    defaults = [200000, 20, 247]
+    values, size, mtu = args + defaults[len(args):]
+    print("%d values of %d bytes, mtu %d" % (values, size, mtu))
+    for coalesce in (False, True):
+        run(values, size, mtu, coalesce)
+
+
+if __name__ == "__main__":
+    main()
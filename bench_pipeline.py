@@ -0,0 +1,207 @@
+"""
+Replay synthetic scanner events through the mqtt encoding and
+publishing, inline on the event loop and through a Pipeline with
+increasing number of workers. Publishing is done as by blus.mqtt, a
+task per message on the event loop, to a client that only encodes the
+payload.
+
+The producer line is the cost left on the scanner thread per event
+(records and ring buffer puts, no workers running), the publish line
+the cost left on the event loop. Inline divided by the larger of them
+is the most the pipeline can gain, however many cores. Workers only
+add throughput on a multi-core host.
+
+  python3 bench_pipeline.py [events] [max workers]
+"""
+
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+
+from blus.mqtt import encode
+from blus.pipeline import BATCH, Pipeline
+
+
+def synthetic_events(count, devices=2000, changing=0.2):
+    """
+    Devices updated in place as by bluez, RSSI on every advertisement
+    and manufacturer data on a fraction of them
+    """
+    random.seed(0)
+    paths = [
+        "/org/bluez/hci0/dev_%s"
+        % "_".join("%02X" % random.randrange(256) for _ in range(6))
+        for _ in range(devices)
+    ]
+    state = {}
+    for i in range(count):
+        path = paths[i % devices]
+        device = state.get(path)
+        if device is None:
+            device = state[path] = dict(
+                Address=path[-17:].replace("_", ":"),
+                AddressType="random",
+                Alias=path[-17:].replace("_", "-"),
+                Paired=False,
+                Trusted=False,
+                Blocked=False,
+                LegacyPairing=False,
+                RSSI=random.randrange(-100, -30),
+                Connected=False,
+                UUIDs=["0000fe9f-0000-1000-8000-00805f9b34fb"],
+                Adapter="/org/bluez/hci0",
+                ManufacturerData={76: list(os.urandom(24))},
+                ServiceData={
+                    "0000fe9f-0000-1000-8000-00805f9b34fb": list(
+                        os.urandom(16)
+                    )
+                },
+                ServicesResolved=False,
+            )
+        else:
+            device["RSSI"] = random.randrange(-100, -30)
+            if random.random() < changing:
+                device["ManufacturerData"] = {76: list(os.urandom(24))}
+        # snapshot, encode adds _quality
+        yield "seen", path, dict(device)
+
+
+async def client_publish(topic, message, retain=False):
+    """in place of MQTTClient.publish"""
+    return topic, message, retain
+
+
+def publisher(loop, count):
+    """publish as blus.mqtt, and a future done after count messages"""
+    finished = loop.create_future()
+    published = [0]
+
+    def publish(topic, payload):
+        async def publish_task():
+            await client_publish(
+                topic,
+                payload.encode("utf-8") if payload else b"",
+                retain=False,
+            )
+            published[0] += 1
+            if published[0] == count:
+                finished.set_result(None)
+
+        loop.create_task(publish_task())
+
+    return publish, finished
+
+
+def on_loop(events, produce):
+    """
+    Time until all events were published, with produce(loop, publish)
+    run in a thread like the scanner
+    """
+    loop = asyncio.new_event_loop()
+    publish, finished = publisher(loop, len(events))
+    thread = threading.Thread(target=produce, args=(loop, publish))
+    start = time.perf_counter()
+    thread.start()
+    loop.run_until_complete(finished)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    loop.close()
+    return elapsed
+
+
+def inline(events):
+    """as blus.mqtt without workers, encode on the event loop"""
+
+    def produce(loop, publish):
+        for event in events:
+            loop.call_soon_threadsafe(
+                lambda event: publish(*encode(*event)), event
+            )
+
+    return on_loop(events, produce)
+
+
+def publish_only(events):
+    """the event loop share of pipelined, encoded ahead"""
+    publications = [encode(*event) for event in events]
+
+    def produce(loop, publish):
+        for start in range(0, len(publications), BATCH):
+            end = start + BATCH
+            loop.call_soon_threadsafe(
+                lambda batch: [publish(*item) for item in batch],
+                publications[start:end],
+            )
+
+    return on_loop(events, produce)
+
+
+def producer(events):
+    pipeline = Pipeline(encode, None, 1, size=256 * 1024 * 1024)
+    start = time.perf_counter()
+    for event in events:
+        pipeline.put(*event)
+    elapsed = time.perf_counter() - start
+    assert not pipeline.dropped
+    return elapsed
+
+
+def pipelined(events, workers):
+    pipelines = []
+
+    def produce(loop, publish):
+        def publish_all(publications):
+            for topic, payload in publications:
+                publish(topic, payload)
+
+        pipeline = Pipeline(
+            encode,
+            lambda publications: loop.call_soon_threadsafe(
+                publish_all, publications
+            ),
+            workers,
+        )
+        pipelines.append(pipeline)
+        pipeline.start()
+        for event in events:
+            pipeline.put(*event, block=True)
+
+    elapsed = on_loop(events, produce)
+    pipelines[0].stop()
+    return elapsed
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:3]]
+    count, max_workers = args + [100000, os.cpu_count()][len(args):]
+
+    def events():
+        return list(synthetic_events(count))
+
+    print("%d events, %d cpus" % (count, os.cpu_count()))
+    inline_time = inline(events())
+    producer_time = producer(events())
+    publish_time = publish_only(events())
+    print("inline      %8d events/s" % (count / inline_time))
+    print("producer    %8d events/s" % (count / producer_time))
+    print(
+        "publish     %8d events/s, ceiling %.1fx inline"
+        % (
+            count / publish_time,
+            inline_time / max(producer_time, publish_time),
+        )
+    )
+    workers = 1
+    while workers <= max_workers:
+        print(
+            "%2d workers  %8d events/s"
+            % (workers, count / pipelined(events(), workers))
+        )
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
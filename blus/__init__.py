@@ -16,12 +16,15 @@ from .const import (
     CHARACTERISTIC_IFACE,
     DESCRIPTOR_IFACE,
 )
-from .device import DeviceManager, DeviceObserver
+from .device import DeviceManager, DeviceObserver, DiscoverySchedule
+from .cache import GattCache
 
 
 __all__ = [
     "DeviceManager",
     "DeviceObserver",
+    "DiscoverySchedule",
+    "GattCache",
     "get_remote_objects",
     "get_object_manager",
     "proxy_for",
@@ -7,50 +7,201 @@ Usage:
   blus [-v|-vv] [options]
   blus [-v|-vv] [options] scan
   blus [-v|-vv] [options] mqtt
+  blus [-v|-vv] [options] profile [scan|mqtt]
+  blus [-v|-vv] [options] aggregate
 
 Options:
   -h --help             Show this message
   -v,-vv                Increase verbosity
   -d                    More debugging
   --version             Show version
+  --profile-dir=DIR     Directory for profile snapshots [default: .]
+  --profile-interval=S  Also write a profile snapshot every S seconds
+  --format=FORMAT       Scan output: table, jsonl or csv [default: table]
+  --duration=S          Stop scanning after S seconds
+  --summary             Print per device count and RSSI when scan stops
+  --scan-window=S       Duty cycle discovery, listening S seconds at a time
+  --scan-pause=S        Duty cycle discovery, pausing S seconds in between
+  --monitor=PATTERNS    Only report devices with advertisements matching
+                        any of the comma separated patterns, given as
+                        ad type:offset:value in hex, e.g. ff:0:4c00
+  --rssi-high=DBM       With --monitor, only report devices stronger than
+                        DBM for --rssi-high-timeout seconds
+  --rssi-high-timeout=S
+  --rssi-low=DBM        With --monitor, devices are lost when weaker than
+                        DBM for --rssi-low-timeout seconds
+  --rssi-low-timeout=S
+  --rssi-sampling=N     With --monitor, RSSI reporting period in units of
+                        100 ms, 0 to report every advertisement
+  --workers=N           Encode in N worker processes (mqtt). Only worth it
+                        on multi-core hosts, throughput is bounded by the
+                        scanner and publishing, not linear in N
+                        [default: 0]
 """
 
+import datetime
 import logging
 
 import docopt
+from gi.repository import GLib
 
-from . import DeviceObserver, DeviceManager, __version__
-from .util import quality_from_dbm
-from . import mqtt
+from . import DeviceObserver, DeviceManager, DiscoverySchedule, __version__
+from . import mqtt, output
+from .monitor import parse_patterns
+from .device import DEFAULT_THROTTLE
 
 
 _LOGGER = logging.getLogger(__name__)
 
 
-def mqtt_gw(args):
+FLUSH_INTERVAL = datetime.timedelta(seconds=1)
+
+# keyword argument to monitor.Monitor for each option
+MONITOR_OPTIONS = dict(
+    rssi_high_threshold="--rssi-high",
+    rssi_high_timeout="--rssi-high-timeout",
+    rssi_low_threshold="--rssi-low",
+    rssi_low_timeout="--rssi-low-timeout",
+    rssi_sampling_period="--rssi-sampling",
+)
+
+
+def discovery_schedule(args):
+    """DiscoverySchedule if any of the duty cycle options given"""
+    kwargs = {
+        key: datetime.timedelta(seconds=float(args[option]))
+        for key, option in (
+            ("window", "--scan-window"),
+            ("pause", "--scan-pause"),
+        )
+        if args[option]
+    }
+    return DiscoverySchedule(**kwargs) if kwargs else None
+
+
+def monitor_patterns(args):
+    return args["--monitor"] and parse_patterns(args["--monitor"])
+
+
+def monitor_options(args):
+    return {
+        key: int(args[option])
+        for key, option in MONITOR_OPTIONS.items()
+        if args[option] is not None
+    }
+
+
+def mqtt_gw(args, profiler=None):
 
     import asyncio
 
     loop = asyncio.get_event_loop()
     loop.set_debug(args["-d"])
     try:
-        loop.run_until_complete(mqtt.run())
+        loop.run_until_complete(
+            mqtt.run(
+                profiler=profiler,
+                schedule=discovery_schedule(args),
+                patterns=monitor_patterns(args),
+                monitor_options=monitor_options(args),
+                workers=int(args["--workers"]),
+            )
+        )
     except KeyboardInterrupt:
         _LOGGER.debug("KeyboardInterrupt, exiting")
 
 
-def scan():
+def scan(args, profiler=None):
+    fmt = args["--format"]
+    if fmt not in output.FORMATS:
+        exit("Unknown format: %s" % fmt)
+
+    out = output.open_stdout()
+    summary = output.Summary() if args["--summary"] else None
+
+    if summary:
+        writer = output.Writer(
+            out, fmt, output.SUMMARY_FIELDS, output.SUMMARY_TABLE
+        )
+        handle = summary.add
+        # aggregation is cheap, count every advertisement
+        throttle = datetime.timedelta(0)
+    else:
+        writer = output.Writer(
+            out, fmt, output.EVENT_FIELDS, output.EVENT_TABLE
+        )
+
+        def handle(path, device):
+            writer.write(output.event_record(path, device))
+
+        throttle = DEFAULT_THROTTLE
+
     class Observer(DeviceObserver):
         def seen(self, manager, path, device):
-            alias = device.get("Alias", path)
-            mac = device.get("Address")
-            q = quality_from_dbm(device.get("RSSI"))
-            print(alias, mac, "on", path, q, "%")
+            handle(path, device)
+
+    manager = DeviceManager(Observer(), throttle=throttle)
+
+    if profiler:
+        profiler.track(manager)
+
+    def flush():
+        writer.flush()
+        return True
+
+    GLib.timeout_add(int(FLUSH_INTERVAL.total_seconds() * 1000), flush)
+
+    if args["--duration"]:
+        GLib.timeout_add(
+            int(float(args["--duration"]) * 1000), lambda: manager.stop()
+        )
 
     try:
-        DeviceManager(Observer()).scan()
+        manager.scan(
+            schedule=discovery_schedule(args),
+            patterns=monitor_patterns(args),
+            monitor_options=monitor_options(args),
+        )
     except KeyboardInterrupt:
         pass
+    finally:
+        if summary:
+            for record in summary.records():
+                writer.write(record)
+        writer.flush()
+
+
+def aggregate(args):
+
+    import asyncio
+
+    from . import aggregate
+
+    loop = asyncio.get_event_loop()
+    loop.set_debug(args["-d"])
+    try:
+        loop.run_until_complete(aggregate.run())
+    except KeyboardInterrupt:
+        _LOGGER.debug("KeyboardInterrupt, exiting")
+
+
+def profile(args):
+    """run scan or mqtt mode, snapshots on SIGUSR1"""
+    from .profiler import Profiler
+
+    interval = args["--profile-interval"]
+    profiler = Profiler(
+        directory=args["--profile-dir"],
+        interval=interval and float(interval),
+    )
+    profiler.start()
+    try:
+        if args["mqtt"]:
+            mqtt_gw(args, profiler)
+        else:
+            scan(args, profiler)
+    finally:
+        profiler.stop()
 
 
 def main():
@@ -73,10 +224,14 @@ def main():
     logging.captureWarnings(True)
     logging.getLogger("blus.device.scan").setLevel(logging.WARNING)
 
-    if args["mqtt"]:
+    if args["profile"]:
+        profile(args)
+    elif args["mqtt"]:
         mqtt_gw(args)
+    elif args["aggregate"]:
+        aggregate(args)
     else:
-        scan()
+        scan(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+# -*- mode: python; coding: utf-8 -*-
+
+import asyncio
+import datetime
+import json
+import logging
+import time
+
+from .util import quality_from_dbm
+
+_LOGGER = logging.getLogger(__name__)
+
+
+GATEWAY_TOPIC = "blus/+/+"
+AGGREGATE_TOPIC = "blus_aggregate"
+
+SMOOTHING = 0.3
+HYSTERESIS = 6
+NODE_TIMEOUT = datetime.timedelta(minutes=2)
+RATE_LIMIT = datetime.timedelta(seconds=10)
+
+
+def address_for_dev_id(dev_id):
+    """dev_AA_BB_CC_DD_EE_FF -> AA:BB:CC:DD:EE:FF"""
+    return dev_id.split("_", 1)[-1].replace("_", ":")
+
+
+def dev_id_for_address(address):
+    return "dev_" + address.replace(":", "_")
+
+
+class Entry:
+
+    __slots__ = ("device", "nodes", "best", "published", "published_best")
+
+    def __init__(self):
+        self.device = {}
+        self.nodes = {}  # node -> [smoothed rssi, last heard]
+        self.best = None
+        self.published = None
+        self.published_best = None
+
+
+class Aggregator:
+    """
+    Merge device reports from several gateways into one entry per
+    address. The RSSI reported by each gateway node is smoothed with an
+    exponential moving average. The best (nearest) node only changes
+    when another node beats it by hysteresis dB, or stops reporting.
+
+    handle() takes a gateway message and returns a (topic, payload)
+    tuple to publish, or None. Malformed messages are logged and
+    ignored. Publications per device are limited to
+    one per rate_limit unless the best node changed.
+    """
+
+    def __init__(
+        self,
+        smoothing=SMOOTHING,
+        hysteresis=HYSTERESIS,
+        node_timeout=NODE_TIMEOUT,
+        rate_limit=RATE_LIMIT,
+        topic=AGGREGATE_TOPIC,
+    ):
+        self.devices = {}
+        self.smoothing = smoothing
+        self.hysteresis = hysteresis
+        self.node_timeout = node_timeout.total_seconds()
+        self.rate_limit = rate_limit.total_seconds()
+        self.topic = topic
+
+    def handle(self, topic, payload, now=None):
+        now = time.time() if now is None else now
+        try:
+            _prefix, node, dev_id = topic.split("/")
+        except ValueError:
+            _LOGGER.error("Unexpected topic %s", topic)
+            return None
+
+        address = address_for_dev_id(dev_id)
+
+        if not payload:
+            return self.lost(node, address, now)
+
+        try:
+            if isinstance(payload, bytes):
+                payload = payload.decode("utf-8")
+            device = json.loads(payload)
+        except ValueError as e:
+            _LOGGER.error("Could not decode payload on %s: %s", topic, e)
+            return None
+
+        if not isinstance(device, dict):
+            _LOGGER.error("Unexpected payload on %s: %s", topic, payload)
+            return None
+
+        return self.update(node, address, device, now)
+
+    def update(self, node, address, device, now):
+        entry = self.devices.get(address)
+        if entry is None:
+            entry = self.devices[address] = Entry()
+
+        entry.device.update(device)
+
+        rssi = device.get("RSSI")
+        reading = entry.nodes.get(node)
+        if reading is None:
+            entry.nodes[node] = [rssi, now]
+        elif rssi is None:
+            reading[1] = now
+        elif reading[0] is None or now - reading[1] > self.node_timeout:
+            reading[0], reading[1] = rssi, now
+        else:
+            reading[0] += self.smoothing * (rssi - reading[0])
+            reading[1] = now
+
+        self._expire_nodes(entry, now)
+        self._select_best(entry)
+        return self._publish(address, entry, now)
+
+    def lost(self, node, address, now):
+        entry = self.devices.get(address)
+        if entry is None or entry.nodes.pop(node, None) is None:
+            return None
+        if not entry.nodes:
+            return self._remove(address)
+        self._select_best(entry)
+        return self._publish(address, entry, now)
+
+    def expire(self, now=None):
+        """Forget silent nodes. Returns list of (topic, payload)"""
+        now = time.time() if now is None else now
+        publications = []
+        for address, entry in list(self.devices.items()):
+            self._expire_nodes(entry, now)
+            if not entry.nodes:
+                publications.append(self._remove(address))
+            elif entry.best not in entry.nodes:
+                self._select_best(entry)
+                publications.append(self._publish(address, entry, now))
+        return [publication for publication in publications if publication]
+
+    def _expire_nodes(self, entry, now):
+        for node, (_rssi, heard) in list(entry.nodes.items()):
+            if now - heard > self.node_timeout:
+                del entry.nodes[node]
+
+    def _select_best(self, entry):
+        candidate = max(
+            entry.nodes,
+            key=lambda node: _rssi_or_floor(entry.nodes[node][0]),
+            default=None,
+        )
+        current = entry.nodes.get(entry.best)
+        if current is not None and (
+            _rssi_or_floor(entry.nodes[candidate][0])
+            < _rssi_or_floor(current[0]) + self.hysteresis
+        ):
+            return
+        entry.best = candidate
+
+    def _publish(self, address, entry, now):
+        if (
+            entry.best == entry.published_best
+            and entry.published is not None
+            and now - entry.published < self.rate_limit
+        ):
+            return None
+        entry.published = now
+        entry.published_best = entry.best
+
+        rssi = entry.nodes[entry.best][0]
+        device = dict(entry.device)
+        device["Address"] = device.get("Address", address)
+        if rssi is not None:
+            device["RSSI"] = round(rssi)
+            device["_quality"] = quality_from_dbm(rssi)
+        device["_node"] = entry.best
+        device["_nodes"] = {
+            node: None if rssi is None else round(rssi)
+            for node, (rssi, _heard) in entry.nodes.items()
+        }
+        return self._topic(address), json.dumps(device)
+
+    def _remove(self, address):
+        del self.devices[address]
+        return self._topic(address), None
+
+    def _topic(self, address):
+        return "/".join([self.topic, dev_id_for_address(address)])
+
+
+def _rssi_or_floor(rssi):
+    return -1000 if rssi is None else rssi
+
+
+async def run(aggregator=None, client=None):
+    """client is a connected MQTTClient, by default one is created"""
+
+    loop = asyncio.get_event_loop()
+
+    from hbmqtt.client import ClientException
+    from hbmqtt.mqtt.constants import QOS_0
+
+    from .mqtt import create_client, connect
+
+    aggregator = aggregator or Aggregator()
+    mqtt = client or create_client("blus_aggregate")
+
+    def publish(publication):
+        topic, payload = publication
+        _LOGGER.debug("Publishing on %s: %s", topic, payload)
+
+        async def publish_task():
+            try:
+                await mqtt.publish(
+                    topic,
+                    payload.encode("utf-8") if payload else b"",
+                    retain=False,
+                )
+            except Exception as e:
+                _LOGGER.error("Failed to publish: %s", e)
+
+        loop.create_task(publish_task())
+
+    if not client and not await connect(mqtt):
+        return
+
+    await mqtt.subscribe([(GATEWAY_TOPIC, QOS_0)])
+    _LOGGER.info("Aggregating %s", GATEWAY_TOPIC)
+
+    async def expire_task():
+        while True:
+            await asyncio.sleep(aggregator.node_timeout)
+            for publication in aggregator.expire():
+                publish(publication)
+            _LOGGER.info("Aggregated devices: %d", len(aggregator.devices))
+
+    async def mqtt_task():
+        while True:
+            try:
+                message = await mqtt.deliver_message()
+                packet = message.publish_packet
+                publication = aggregator.handle(
+                    packet.variable_header.topic_name, packet.payload.data
+                )
+                if publication:
+                    publish(publication)
+            except ClientException as e:
+                _LOGGER.error("MQTT Client exception: %s", e)
+            except asyncio.CancelledError:
+                _LOGGER.debug("mqtt cancelled, disconnecting")
+                await mqtt.disconnect()
+                _LOGGER.info("mqtt disconnected")
+                raise
+            except Exception:
+                _LOGGER.exception("Could not handle message")
+
+    await asyncio.gather(expire_task(), mqtt_task())
@@ -0,0 +1,146 @@
+# -*- mode: python; coding: utf-8 -*-
+
+import json
+import logging
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+
+DATABASE_HASH_UUID = "00002b2a-0000-1000-8000-00805f9b34fb"
+
+
+def default_cache_file():
+    """~/.cache/blus/gatt.json"""
+    return os.path.join(
+        os.environ.get(
+            "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+        ),
+        "blus",
+        "gatt.json",
+    )
+
+
+class GattCache:
+    """
+    Map of service and characteristic UUID to object path per device
+    address and Database Hash, persisted as json so that known
+    characteristics can be used on reconnect without waiting for
+    ServicesResolved.
+
+    Object paths in bluez follow the attribute handles, so they stay
+    valid as long as the GATT database is unchanged. Layouts are stored
+    per Database Hash, or under "" while the hash is unknown. A lookup
+    before bluez has read the hash only hits if a single layout is
+    known for the device.
+
+    Keying by hash only applies once the Database Hash value has been
+    read. bluez only has the value once it was read over D-Bus, so when
+    services are first resolved the layout is normally stored under "".
+    It moves to its hash on the next update after the value was read.
+    """
+
+    def __init__(self, fname=None):
+        self.fname = fname or default_cache_file()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.fname) as f:
+                entries = json.load(f)
+            _LOGGER.info(
+                "Loaded GATT cache for %d devices from %s",
+                len(entries),
+                self.fname,
+            )
+            return entries
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            _LOGGER.error("Could not read GATT cache %s: %s", self.fname, e)
+            return {}
+
+    def save(self):
+        tmp = self.fname + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.fname)
+        except OSError as e:
+            _LOGGER.error("Could not write GATT cache %s: %s", self.fname, e)
+
+    def lookup(self, address, db_hash=None):
+        """Cached entry for address and database hash"""
+        layouts = self.entries.get(address, {})
+        if db_hash:
+            return layouts.get(db_hash)
+        if len(layouts) == 1:
+            return next(iter(layouts.values()))
+        return None
+
+    def invalidate(self, address, db_hash=None):
+        """Forget layout db_hash, or all layouts, of address"""
+        layouts = self.entries.get(address)
+        if not layouts:
+            return
+        if db_hash:
+            if layouts.pop(db_hash, None) is None:
+                return
+        else:
+            layouts.clear()
+        if not layouts:
+            del self.entries[address]
+        _LOGGER.info("Invalidated GATT cache of %s", address)
+        self.save()
+
+    def characteristic(self, address, uuid, db_hash=None):
+        """Cached object path of characteristic uuid on device"""
+        entry = self.lookup(address, db_hash)
+        return entry and entry["characteristics"].get(uuid.lower())
+
+    def update(self, manager, device_path):
+        """
+        Map resolved services of device in DeviceManager manager, under
+        the Database Hash if its value was read, else under ""
+        """
+        address = manager.get_device(device_path)["Address"]
+        db_hash = database_hash(manager, device_path) or ""
+
+        entry = dict(services={}, characteristics={})
+        # first path wins for UUIDs occurring more than once
+        for service_path, service in sorted(manager.services(device_path)):
+            entry["services"].setdefault(service["UUID"].lower(), service_path)
+            for path, characteristic in sorted(
+                manager.characteristics(service_path)
+            ):
+                entry["characteristics"].setdefault(
+                    characteristic["UUID"].lower(), path
+                )
+
+        layouts = self.entries.get(address, {})
+        if not entry["characteristics"] or layouts.get(db_hash) == entry:
+            return
+        _LOGGER.info(
+            "Caching %d characteristics of %s",
+            len(entry["characteristics"]),
+            address,
+        )
+        if db_hash:
+            # a layout without hash can not be told apart any longer
+            layouts.pop("", None)
+        else:
+            layouts.clear()
+        layouts[db_hash] = entry
+        self.entries[address] = layouts
+        self.save()
+
+
+def database_hash(manager, device_path):
+    """Database Hash of device if known by bluez, else None"""
+    for service_path, _service in manager.services(device_path):
+        for _path, characteristic in manager.characteristics(service_path):
+            uuid = characteristic["UUID"].lower()
+            if uuid == DATABASE_HASH_UUID and characteristic.get("Value"):
+                return bytes(characteristic["Value"]).hex()
+    return None
@@ -17,3 +17,6 @@ LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
 LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
 
 BATTERY_IFACE = "org.bluez.Battery1"
+
+ADV_MONITOR_IFACE = "org.bluez.AdvertisementMonitor1"
+ADV_MONITOR_MANAGER_IFACE = "org.bluez.AdvertisementMonitorManager1"
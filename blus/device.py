@@ -8,6 +8,8 @@ import pydbus
 from gi.repository import GLib
 
 from . import __version__
+from . import monitor
+from .cache import database_hash
 from .util import (
     get_remote_objects,
     get_object_manager,
@@ -32,6 +34,9 @@ _LOGGER_SCAN = logging.getLogger(__name__ + ".scan")
 DEFAULT_PURGE_TIMEOUT = datetime.timedelta(minutes=5)
 PERIODIC_CHECK_INTERVAL = datetime.timedelta(seconds=30)
 DEFAULT_THROTTLE = datetime.timedelta(seconds=10)
+ENUMERATION_SLICE = datetime.timedelta(milliseconds=20)
+DEFAULT_SCAN_WINDOW = datetime.timedelta(seconds=10)
+DEFAULT_SCAN_PAUSE = datetime.timedelta(seconds=20)
 
 
 class DeviceObserver:
@@ -52,6 +57,43 @@ def is_device(interfaces):
     return DEVICE_IFACE in interfaces
 
 
+class DiscoverySchedule:
+    """
+    Duty cycle for discovery: listen for window seconds, then pause.
+
+    While new devices show up, the window grows and the pause shrinks
+    by factor per cycle, up to max_factor times the configured values.
+    When no new devices are found they return towards window and pause.
+
+    BlueZ keeps expiring devices while discovery is paused. With a pause
+    longer than its TemporaryTimeout (30 s by default), devices are still
+    removed, and reported through unseen, while we are not listening.
+    """
+
+    def __init__(
+        self,
+        window=DEFAULT_SCAN_WINDOW,
+        pause=DEFAULT_SCAN_PAUSE,
+        factor=1.5,
+        max_factor=4,
+    ):
+        self.min_window = self.window = window.total_seconds()
+        self.max_pause = self.pause = pause.total_seconds()
+        self.max_window = self.min_window * max_factor
+        self.min_pause = self.max_pause / max_factor
+        self.factor = factor
+
+    def adapt(self, new_devices):
+        """Next (window, pause) given devices added in last window"""
+        if new_devices:
+            self.window = min(self.window * self.factor, self.max_window)
+            self.pause = max(self.pause / self.factor, self.min_pause)
+        else:
+            self.window = max(self.window / self.factor, self.min_window)
+            self.pause = min(self.pause * self.factor, self.max_pause)
+        return self.window, self.pause
+
+
 class DeviceManager:
     def __init__(
         self,
@@ -59,12 +101,22 @@ class DeviceManager:
         device=None,
         purge_timeout=DEFAULT_PURGE_TIMEOUT,
         throttle=DEFAULT_THROTTLE,
+        gatt_cache=None,
     ):
 
         assert purge_timeout >= PERIODIC_CHECK_INTERVAL
 
         self.objects = get_remote_objects()
         self.last_seen = {}
+        self.main_loop = None
+        self.stopping = False
+        self.known_addresses = set()
+        self.new_devices = 0
+        self.deaf_time = 0
+        self.deaf_since = None
+        self.monitored = None
+        self.monitor_objects = None
+        self.gatt_cache = gatt_cache
         self.observer = observer
         self.purge_timeout = purge_timeout.total_seconds()
         self.throttle = throttle.total_seconds()
@@ -77,12 +129,18 @@ class DeviceManager:
         _LOGGER.info("Known adapters: %d", _len(self.adapters))
         _LOGGER.info("Total known devices: %d", _len(self.devices))
 
+        self.known_addresses.update(
+            interfaces[DEVICE_IFACE].get("Address")
+            for _path, interfaces in self.devices
+        )
+
         adapter = self.get_adapter(device)
 
         if not adapter:
             exit("No adapter found")
 
         path, _ = adapter
+        self.adapter_path = path
         self.adapter = proxy_for(path)
 
         _LOGGER.info(
@@ -106,11 +164,33 @@ class DeviceManager:
 
         GLib.idle_add(periodic_check)
 
+    def listening_time(self):
+        """
+        Wall clock time minus time spent with discovery paused by a
+        DiscoverySchedule. Used for last seen, so that throttling and
+        purging only count time when we were listening
+        """
+        now = time.time()
+        deaf_time = self.deaf_time
+        if self.deaf_since:
+            deaf_time += now - self.deaf_since
+        return now - deaf_time
+
     def update_last_seen(self, path):
-        self.last_seen[path] = time.time()
+        self.last_seen[path] = self.listening_time()
+
+    def is_monitored(self, path):
+        """False for devices not matched by an advertisement monitor"""
+        return self.monitored is None or path in self.monitored
 
     def see_device(self, path):
-        if time.time() - self.last_seen[path] < self.throttle:
+        if not self.is_monitored(path):
+            return
+        if path not in self.last_seen:
+            # not yet reached by the initial enumeration
+            self.discover_device(path)
+            return
+        if self.listening_time() - self.last_seen[path] < self.throttle:
             # FIXME: might hide state changes of interest
             _LOGGER.debug("Skipping recently seen %s", path)
             return
@@ -121,10 +201,22 @@ class DeviceManager:
         self.update_last_seen(path)
         self.observer.discovered(self, path, self.get_device(path))
 
+    def device_found(self, path):
+        """DeviceFound from advertisement monitor"""
+        self.monitored.add(path)
+        if path in self.objects and self.get_device(path):
+            self.discover_device(path)
+
+    def device_lost(self, path):
+        """DeviceLost from advertisement monitor"""
+        self.monitored.discard(path)
+        self.observer.unseen(self, path)
+
     def purge_unseen_devices(self):
         _LOGGER.debug("last seen length %d", len(self.last_seen))
+        now = self.listening_time()
         for path, last_seen in self.last_seen.items():
-            if time.time() - last_seen < self.purge_timeout:
+            if now - last_seen < self.purge_timeout:
                 continue
             _LOGGER.error(
                 "Haven't seen %s in %d seconds", path, self.purge_timeout
@@ -174,6 +266,31 @@ class DeviceManager:
             None,
         )
 
+    def characteristic(self, device_path, uuid):
+        """
+        Object path of characteristic uuid on device, if exported by
+        bluez. The path from the GattCache is tried first, bluez exports
+        attributes from its own cache before ServicesResolved
+        """
+        uuid = uuid.lower()
+        if self.gatt_cache:
+            address = self.get_device(device_path)["Address"]
+            db_hash = database_hash(self, device_path)
+            path = self.gatt_cache.characteristic(address, uuid, db_hash)
+            if path and path.startswith(device_path + "/"):
+                exported = self.objects.get(path, {}).get(CHARACTERISTIC_IFACE)
+                if exported and exported["UUID"].lower() == uuid:
+                    return path
+                if exported:
+                    # another attribute at that handle now
+                    _LOGGER.info("Cached GATT map of %s is stale", address)
+                    self.gatt_cache.invalidate(address, db_hash)
+        for service_path, _service in self.services(device_path):
+            for path, characteristic in self.characteristics(service_path):
+                if characteristic["UUID"].lower() == uuid:
+                    return path
+        return None
+
     def _get_branch(self, interface, parent_name, parent_path):
         """shorthand"""
         return (
@@ -215,8 +332,15 @@ class DeviceManager:
         else:
             self.objects[path] = interfaces
 
-        if self.get_device(path):
-            self.discover_device(path)
+        device = self.get_device(path)
+        if device:
+            # bluez removes and re-adds temporary devices, count each once
+            address = device.get("Address")
+            if address not in self.known_addresses:
+                self.known_addresses.add(address)
+                self.new_devices += 1
+            if self.is_monitored(path):
+                self.discover_device(path)
 
         _LOGGER.debug("Added %s. Total known %d", path, len(self.objects))
 
@@ -234,6 +358,12 @@ class DeviceManager:
 
         if changed:
             self.objects[path][interface].update(changed)
+            if (
+                self.gatt_cache
+                and interface == DEVICE_IFACE
+                and changed.get("ServicesResolved")
+            ):
+                self.gatt_cache.update(self, path)
 
         _LOGGER_SCAN.debug(
             "Properties changed on %s/%s: %s -- %s",
@@ -256,64 +386,193 @@ class DeviceManager:
         if DEVICE_IFACE in interfaces:
             self.observer.unseen(self, path)
 
+        if self.gatt_cache and SERVICE_IFACE in interfaces:
+            self._service_removed(path)
+
         for interface in interfaces:
             del self.objects[path][interface]
 
         # if no interface left
         if not self.objects[path]:
             del self.objects[path]
-            del self.last_seen[path]
+            self.last_seen.pop(path, None)
             _LOGGER.debug("%s removed", path)
 
-    def scan(self, transport="le", device=None):
+    def _service_removed(self, path):
+        device_path = self.objects[path][SERVICE_IFACE].get("Device")
+        device = self.objects.get(device_path, {}).get(DEVICE_IFACE, {})
+        # on disconnect services go after Connected or ServicesResolved
+        # is cleared, while connected it is a Service Changed indication
+        if device.get("Connected") and device.get("ServicesResolved"):
+            _LOGGER.info("Services of %s changed", device_path)
+            self.gatt_cache.invalidate(device["Address"])
+
+    def stop(self):
+        """Make scan return. Can be called from any thread"""
+        self.stopping = True
+        if self.main_loop:
+            self.main_loop.quit()
+
+    def start_discovery(self, transport="le"):
+        discovery_filter = {}
+        if transport:
+            discovery_filter = dict(Transport=pydbus.Variant("s", transport))
+
+        try:
+            _LOGGER.info("discovering...")
+            self.adapter.SetDiscoveryFilter(discovery_filter)
+            self.adapter.StartDiscovery()
+            _LOGGER.info("... discovery started")
+        except GLib.Error as e:
+            _LOGGER.error("Could not start discovery: %s", e)
+
+        if self.deaf_since:
+            self.deaf_time += time.time() - self.deaf_since
+            self.deaf_since = None
+
+    def pause_discovery(self):
+        try:
+            self.adapter.StopDiscovery()
+            _LOGGER.info("discovery paused")
+        except GLib.Error as e:
+            _LOGGER.error("Could not stop discovery: %s", e)
+
+        self.deaf_since = time.time()
+
+    def scan(
+        self,
+        transport="le",
+        device=None,
+        schedule=None,
+        patterns=None,
+        monitor_options=None,
+    ):
         """
         Valid values for tranport: "le", "bredr", "auto"
         https://git.kernel.org/pub/scm/bluetooth/bluez.git/tree/doc/device-api.txt
 
+        With a DiscoverySchedule, discovery is paused between windows.
+        Note that bluez may remove temporary devices while paused
+
+        With patterns (list of monitor.Pattern), an advertisement monitor
+        is registered and only matching devices are reported, falling
+        back to discovery of all devices if not supported by bluez.
+        monitor_options are the RSSI keyword arguments of monitor.Monitor
+
         For asyncio this can be run in it's own thread
         But the callback in DeviceObserver needs to be
         bridged with loop.call_soon_threadsafe then
         """
 
-        def start_discovery():
-
-            _LOGGER.debug("Discovery signals for known devices...")
-            for path, _interfaces in self.objects.items():
-                if self.get_device(path):
+        def _relevant_interfaces(interfaces):
+            irrelevant_interfaces = {
+                "org.freedesktop.DBus.Properties",
+                "org.freedesktop.DBus.Introspectable",
+            }
+            return set(interfaces) - irrelevant_interfaces
+
+        def enumerate_known_objects():
+            """
+            Discovery signals for known devices, in slices of
+            ENUMERATION_SLICE so that live signals are handled meanwhile
+            """
+            debug = _LOGGER.isEnabledFor(logging.DEBUG)
+            slice_seconds = ENUMERATION_SLICE.total_seconds()
+            deadline = time.monotonic() + slice_seconds
+            for path in list(self.objects):
+                interfaces = self.objects.get(path)
+                if not interfaces:
+                    # removed since enumeration started
+                    continue
+                if debug:
+                    _LOGGER.debug(
+                        "%-45s: %s",
+                        path,
+                        ", ".join(_relevant_interfaces(interfaces.keys())),
+                    )
+                if (
+                    DEVICE_IFACE in interfaces
+                    and path not in self.last_seen
+                    and self.is_monitored(path)
+                ):
                     self.discover_device(path)
-
-            def _relevant_interfaces(interfaces):
-                irrelevant_interfaces = {
-                    "org.freedesktop.DBus.Properties",
-                    "org.freedesktop.DBus.Introspectable",
-                }
-                return set(interfaces) - irrelevant_interfaces
-
-            for path, interfaces in self.objects.items():
+                if self.gatt_cache and interfaces.get(DEVICE_IFACE, {}).get(
+                    "ServicesResolved"
+                ):
+                    self.gatt_cache.update(self, path)
+                if time.monotonic() >= deadline:
+                    yield True
+                    deadline = time.monotonic() + slice_seconds
+            _LOGGER.debug("Known objects enumerated")
+            yield False
+
+        def window_started():
+            new_devices = self.new_devices
+
+            def window_ended():
+                self.pause_discovery()
+                window, pause = schedule.adapt(self.new_devices - new_devices)
                 _LOGGER.debug(
-                    "%-45s: %s",
-                    path,
-                    ", ".join(_relevant_interfaces(interfaces.keys())),
+                    "Next discovery window %.1fs after %.1fs", window, pause
                 )
+                GLib.timeout_add(int(pause * 1000), window_started)
+                return False
+
+            self.start_discovery(transport)
+            GLib.timeout_add(int(schedule.window * 1000), window_ended)
+            return False
 
-            discovery_filter = {}
-            if transport:
-                discovery_filter = dict(
-                    Transport=pydbus.Variant("s", transport)
+        def start_scanning():
+            if schedule:
+                window_started()
+            else:
+                self.start_discovery(transport)
+
+        def monitor_registered(error):
+            if error:
+                _LOGGER.warning("Could not monitor, discovering instead")
+                self.monitored = None
+                self.monitor_objects = None
+                start_scanning()
+                # known devices enumerated while waiting were not monitored
+                GLib.idle_add(enumerate_known_objects().__next__)
+
+        def start():
+
+            if self.stopping:
+                # stop() before the main loop was running
+                self.main_loop.quit()
+                return False
+
+            adapter_interfaces = self.objects[self.adapter_path]
+            if patterns and monitor.is_supported(adapter_interfaces):
+                _LOGGER.info(
+                    "Monitoring advertisements, offloaded to controller: %s",
+                    monitor.is_offloaded(adapter_interfaces),
                 )
+                self.monitored = set()
+                self.monitor_objects = monitor.register_monitor(
+                    self.adapter_path,
+                    patterns,
+                    self.device_found,
+                    self.device_lost,
+                    monitor_registered,
+                    **(monitor_options or {})
+                )
+            else:
+                if patterns:
+                    _LOGGER.warning(
+                        "Advertisement monitor not supported, discovering"
+                    )
+                start_scanning()
 
-            try:
-                _LOGGER.info("discovering...")
-                self.adapter.SetDiscoveryFilter(discovery_filter)
-                self.adapter.StartDiscovery()
-                _LOGGER.info("... discovery started")
-            except GLib.Error as e:
-                _LOGGER.error("Could not start discovery: %s", e)
+            _LOGGER.debug("Discovery signals for known devices...")
+            GLib.idle_add(enumerate_known_objects().__next__)
 
             return False
 
         def run_loop():
-            main_loop = GLib.MainLoop()
+            main_loop = self.main_loop = GLib.MainLoop()
             try:
                 _LOGGER.info("Running main loop")
                 main_loop.run()
@@ -328,7 +587,7 @@ class DeviceManager:
                 main_loop.quit()
                 _LOGGER.info("Scanner kthxbye")
 
-        GLib.idle_add(start_discovery)
+        GLib.idle_add(start)
 
         object_manager = get_object_manager()
         bus = pydbus.SystemBus()
@@ -348,4 +607,11 @@ class DeviceManager:
             arg0=DESCRIPTOR_IFACE,
             signal_fired=self._properties_changed,
         ):
-            run_loop()
+            try:
+                run_loop()
+            finally:
+                if self.monitor_objects:
+                    monitor.unregister_monitor(
+                        self.adapter_path, self.monitor_objects
+                    )
+                    self.monitor_objects = None
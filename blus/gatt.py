@@ -0,0 +1,415 @@
+# -*- mode: python; coding: utf-8 -*-
+
+import logging
+import os
+import platform
+import socket
+from collections import deque
+
+import pydbus
+from pydbus.generic import signal
+from gi.repository import GLib
+
+from .const import (
+    SERVICE_IFACE,
+    CHARACTERISTIC_IFACE,
+    GATT_MANAGER_IFACE,
+    LE_ADVERTISING_MANAGER_IFACE,
+)
+from .util import ObjectManager, call_async, proxy_for, read_introspection
+
+_LOGGER = logging.getLogger(__name__)
+
+
+GATT_ROOT = "/org/blus/gatt"
+ADVERTISEMENT_PATH = "/org/blus/advertisement0"
+
+DEFAULT_MTU = 23
+ATT_HEADER = 3
+MAX_PENDING = 256
+
+
+class Notifier:
+    """
+    Notifications over a socket from AcquireNotify. Every packet
+    written is one notification, at most mtu - ATT_HEADER bytes.
+
+    Values are queued and written in bulk by flush(). With coalesce,
+    consecutive values are packed into the same notification while
+    they fit, so the receiver must be able to split them.
+
+    At most max_pending notifications are queued. When a slow receiver
+    keeps the socket full, the oldest are dropped and counted.
+    """
+
+    def __init__(self, sock, mtu, coalesce=False, max_pending=MAX_PENDING):
+        self.sock = sock
+        self.max_size = mtu - ATT_HEADER
+        self.coalesce = coalesce
+        self.pending = deque(maxlen=max_pending)
+        self.dropped = 0
+
+    def queue(self, value):
+        if len(value) > self.max_size:
+            raise ValueError(
+                "Value of %d bytes exceeds %d" % (len(value), self.max_size)
+            )
+        if (
+            self.coalesce
+            and self.pending
+            and len(self.pending[-1]) + len(value) <= self.max_size
+        ):
+            self.pending[-1] += value
+        else:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(bytearray(value))
+
+    def flush(self):
+        """Write queued packets. False if the socket is full"""
+        while self.pending:
+            try:
+                self.sock.send(self.pending[0])
+            except BlockingIOError:
+                return False
+            self.pending.popleft()
+        return True
+
+    def close(self):
+        if self.dropped:
+            _LOGGER.warning("Dropped %d notifications", self.dropped)
+        self.pending.clear()
+        self.sock.close()
+
+
+def _socketpair():
+    """(ours, fd for bluez)"""
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    ours.setblocking(False)
+    fd = theirs.detach()
+
+    def close():
+        # our copy of the fd, after it was passed in the method reply
+        os.close(fd)
+        return False
+
+    GLib.idle_add(close)
+    return ours, fd
+
+
+class Characteristic:
+    """
+    GATT characteristic exported to bluez. read is called with no
+    arguments and returns the value, write is called with each written
+    value. Flags as in bluez gatt-api.txt, e.g. ["read", "notify"].
+
+    Clients acquiring notifications get a socket and values passed to
+    notify() are written to it in bulk from the main loop, instead of
+    one PropertiesChanged signal per value. Acquiring needs unix fd
+    support in pydbus, without it acquire is False and bluez falls back
+    to StartNotify and WriteValue.
+    """
+
+    PropertiesChanged = signal()
+
+    def __init__(self, uuid, flags, read=None, write=None, coalesce=False):
+        self.UUID = uuid
+        self.Flags = flags
+        self.Service = "/"
+        self.Value = b""
+        self.Notifying = False
+        self.NotifyAcquired = False
+        self.WriteAcquired = False
+        self.read = read
+        self.write = write
+        self.coalesce = coalesce
+        self.acquire = True
+        self.notifier = None
+        self.notify_watch = None
+        self.flush_scheduled = False
+        self.write_socket = None
+        self.write_mtu = DEFAULT_MTU
+        self.write_watch = None
+
+    def properties(self):
+        properties = dict(
+            UUID=pydbus.Variant("s", self.UUID),
+            Service=pydbus.Variant("o", self.Service),
+            Flags=pydbus.Variant("as", self.Flags),
+        )
+        if self.acquire:
+            # bluez only calls Acquire* if these properties exist
+            properties.update(
+                NotifyAcquired=pydbus.Variant("b", self.NotifyAcquired),
+                WriteAcquired=pydbus.Variant("b", self.WriteAcquired),
+            )
+        return {CHARACTERISTIC_IFACE: properties}
+
+    def _changed(self, **changed):
+        for key, value in changed.items():
+            setattr(self, key, value)
+        self.PropertiesChanged(CHARACTERISTIC_IFACE, changed, [])
+
+    def notify(self, value):
+        if self.notifier:
+            self.notifier.queue(value)
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                GLib.idle_add(self._flush)
+        elif self.Notifying:
+            self._changed(Value=bytes(value))
+
+    def _flush(self, *_args):
+        self.flush_scheduled = False
+        if not self.notifier:
+            return False
+        try:
+            if not self.notifier.flush():
+                # socket full, continue when writable
+                self.flush_scheduled = True
+                GLib.io_add_watch(
+                    self.notifier.sock.fileno(),
+                    GLib.PRIORITY_DEFAULT,
+                    GLib.IO_OUT,
+                    self._flush,
+                )
+        except OSError as e:
+            _LOGGER.info("Notify socket closed: %s", e)
+            self._release_notify()
+        return False
+
+    def _release_notify(self):
+        if self.notify_watch:
+            GLib.source_remove(self.notify_watch)
+            self.notify_watch = None
+        if self.notifier:
+            self.notifier.close()
+            self.notifier = None
+            self._changed(NotifyAcquired=False)
+
+    def _release_write(self):
+        if self.write_watch:
+            GLib.source_remove(self.write_watch)
+            self.write_watch = None
+        if self.write_socket:
+            self.write_socket.close()
+            self.write_socket = None
+            self._changed(WriteAcquired=False)
+
+    def ReadValue(self, options):
+        if self.read:
+            self.Value = bytes(self.read())
+        return self.Value
+
+    def WriteValue(self, value, options):
+        self.Value = bytes(value)
+        if self.write:
+            self.write(self.Value)
+
+    def StartNotify(self):
+        _LOGGER.debug("StartNotify %s", self.UUID)
+        self._changed(Notifying=True)
+
+    def StopNotify(self):
+        _LOGGER.debug("StopNotify %s", self.UUID)
+        self._changed(Notifying=False)
+
+    def AcquireNotify(self, options):
+        mtu = options.get("mtu", DEFAULT_MTU)
+        _LOGGER.debug("AcquireNotify %s mtu %d", self.UUID, mtu)
+        self._release_notify()
+        ours, fd = _socketpair()
+        self.notifier = Notifier(ours, mtu, self.coalesce)
+
+        def hangup(_fd, _conditions):
+            self.notify_watch = None
+            self._release_notify()
+            return False
+
+        self.notify_watch = GLib.io_add_watch(
+            ours.fileno(),
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_HUP | GLib.IO_ERR,
+            hangup,
+        )
+        self._changed(NotifyAcquired=True)
+        return fd, mtu
+
+    def AcquireWrite(self, options):
+        mtu = options.get("mtu", DEFAULT_MTU)
+        _LOGGER.debug("AcquireWrite %s mtu %d", self.UUID, mtu)
+        self._release_write()
+        self.write_socket, fd = _socketpair()
+        self.write_mtu = mtu
+
+        def readable(_fd, _conditions):
+            # drain all packets written since last wakeup
+            while True:
+                try:
+                    value = self.write_socket.recv(self.write_mtu)
+                except BlockingIOError:
+                    return True
+                except OSError:
+                    break
+                if not value:
+                    break
+                self.Value = value
+                if self.write:
+                    self.write(value)
+            self.write_watch = None
+            self._release_write()
+            return False
+
+        self.write_watch = GLib.io_add_watch(
+            self.write_socket.fileno(),
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            readable,
+        )
+        self._changed(WriteAcquired=True)
+        return fd, mtu
+
+
+class Service:
+    def __init__(self, uuid, characteristics, primary=True):
+        self.UUID = uuid
+        self.Primary = primary
+        self.characteristics = characteristics
+
+    def properties(self):
+        return {
+            SERVICE_IFACE: dict(
+                UUID=pydbus.Variant("s", self.UUID),
+                Primary=pydbus.Variant("b", self.Primary),
+            )
+        }
+
+
+class Advertisement:
+
+    Type = "peripheral"
+
+    def __init__(
+        self,
+        local_name=None,
+        service_uuids=(),
+        manufacturer_data=None,
+        includes=("tx-power",),
+    ):
+        self.LocalName = local_name or platform.node()
+        self.ServiceUUIDs = list(service_uuids)
+        self.ManufacturerData = {
+            company: pydbus.Variant("ay", data)
+            for company, data in (manufacturer_data or {}).items()
+        }
+        self.Includes = list(includes)
+
+    def Release(self):
+        _LOGGER.debug("Advertisement released")
+
+
+def has_unix_fd_support():
+    try:
+        from pydbus import unixfd  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def register_application(adapter_path, services, done, root=GATT_ROOT):
+    """
+    Export services (list of Service) and register them with bluez.
+    done is called with None or GLib.Error once bluez replied
+    """
+
+    acquire = has_unix_fd_support()
+    if not acquire:
+        _LOGGER.warning(
+            "No support for unix fd in pydbus, "
+            "notifying with PropertiesChanged"
+        )
+
+    manager = ObjectManager(root)
+    for i, service in enumerate(services):
+        service_path = "%s/service%d" % (root, i)
+        manager.add(service_path, service, "gatt_service.xml")
+        for j, characteristic in enumerate(service.characteristics):
+            characteristic.Service = service_path
+            characteristic.acquire = acquire
+            manager.add(
+                "%s/char%d" % (service_path, j),
+                characteristic,
+                "gatt_characteristic.xml",
+            )
+    manager.register()
+
+    def registered(error):
+        if error:
+            manager.unregister()
+        else:
+            _LOGGER.info("Registered GATT application %s", root)
+        done(error)
+
+    call_async(
+        adapter_path,
+        GATT_MANAGER_IFACE,
+        "RegisterApplication",
+        "(oa{sv})",
+        (root, {}),
+        registered,
+    )
+
+    return manager
+
+
+def register_advertisement(
+    adapter_path, done, path=ADVERTISEMENT_PATH, **kwargs
+):
+    """
+    Advertise as a peripheral. Keyword arguments as for Advertisement.
+    done is called with None or GLib.Error once bluez replied
+    """
+
+    registration = pydbus.SystemBus().register_object(
+        path, Advertisement(**kwargs), read_introspection("advertisement.xml")
+    )
+
+    def registered(error):
+        if error:
+            registration.unregister()
+        else:
+            _LOGGER.info("Advertising %s", path)
+        done(error)
+
+    call_async(
+        adapter_path,
+        LE_ADVERTISING_MANAGER_IFACE,
+        "RegisterAdvertisement",
+        "(oa{sv})",
+        (path, {}),
+        registered,
+    )
+
+    return registration
+
+
+def unregister_application(adapter_path, manager):
+    """Undo register_application, manager is the ObjectManager it returned"""
+    try:
+        proxy_for(adapter_path).UnregisterApplication(manager.path)
+        _LOGGER.info("Unregistered GATT application %s", manager.path)
+    except GLib.Error as e:
+        _LOGGER.warning("Could not unregister GATT application: %s", e)
+    manager.unregister()
+
+
+def unregister_advertisement(
+    adapter_path, registration, path=ADVERTISEMENT_PATH
+):
+    """Undo register_advertisement, registration is what it returned"""
+    try:
+        proxy_for(adapter_path).UnregisterAdvertisement(path)
+        _LOGGER.info("Stopped advertising %s", path)
+    except GLib.Error as e:
+        _LOGGER.warning("Could not unregister advertisement: %s", e)
+    registration.unregister()
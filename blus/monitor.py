@@ -0,0 +1,138 @@
+# -*- mode: python; coding: utf-8 -*-
+
+import logging
+from collections import namedtuple
+
+import pydbus
+from gi.repository import GLib
+
+from .const import ADV_MONITOR_IFACE, ADV_MONITOR_MANAGER_IFACE
+from .util import ObjectManager, call_async, proxy_for
+
+_LOGGER = logging.getLogger(__name__)
+
+
+MONITOR_ROOT = "/org/blus/monitor"
+
+# property name and D-Bus type for keyword arguments to Monitor
+RSSI_OPTIONS = dict(
+    rssi_low_threshold=("RSSILowThreshold", "n"),
+    rssi_high_threshold=("RSSIHighThreshold", "n"),
+    rssi_low_timeout=("RSSILowTimeout", "q"),
+    rssi_high_timeout=("RSSIHighTimeout", "q"),
+    rssi_sampling_period=("RSSISamplingPeriod", "q"),
+)
+
+
+class Pattern(namedtuple("Pattern", "ad_type offset value")):
+    """Match value (bytes) at offset in advertising data of ad_type"""
+
+    @classmethod
+    def parse(cls, text):
+        """ff:0:4c00 -> Pattern(0xff, 0, b"\\x4c\\x00")"""
+        ad_type, offset, value = text.split(":")
+        return cls(int(ad_type, 16), int(offset), bytes.fromhex(value))
+
+
+def parse_patterns(text):
+    """comma separated patterns"""
+    return [Pattern.parse(pattern) for pattern in text.split(",")]
+
+
+def is_supported(adapter_interfaces):
+    """True if adapter (interfaces from objects) can monitor patterns"""
+    manager = adapter_interfaces.get(ADV_MONITOR_MANAGER_IFACE)
+    return bool(manager) and "or_patterns" in manager.get(
+        "SupportedMonitorTypes", []
+    )
+
+
+def is_offloaded(adapter_interfaces):
+    """True if matching is done by the controller and not bluetoothd"""
+    manager = adapter_interfaces.get(ADV_MONITOR_MANAGER_IFACE, {})
+    return "controller-patterns" in manager.get("SupportedFeatures", [])
+
+
+class Monitor:
+    def __init__(self, patterns, found, lost, **kwargs):
+        self.patterns = patterns
+        self.found = found
+        self.lost = lost
+        self.options = {
+            RSSI_OPTIONS[key]: value for key, value in kwargs.items()
+        }
+
+    def properties(self):
+        properties = dict(
+            Type=pydbus.Variant("s", "or_patterns"),
+            Patterns=pydbus.Variant(
+                "a(yyay)",
+                [
+                    (pattern.offset, pattern.ad_type, pattern.value)
+                    for pattern in self.patterns
+                ],
+            ),
+        )
+        for (name, signature), value in self.options.items():
+            properties[name] = pydbus.Variant(signature, value)
+        return {ADV_MONITOR_IFACE: properties}
+
+    def Release(self):
+        _LOGGER.debug("Release")
+
+    def Activate(self):
+        _LOGGER.info("Monitor activated")
+
+    def DeviceFound(self, device):
+        _LOGGER.debug("DeviceFound %s", device)
+        self.found(device)
+
+    def DeviceLost(self, device):
+        _LOGGER.debug("DeviceLost %s", device)
+        self.lost(device)
+
+
+def register_monitor(
+    adapter_path, patterns, found, lost, done, root=MONITOR_ROOT, **kwargs
+):
+    """
+    Register an or_patterns monitor on adapter. found and lost are
+    called with device paths, done with None or GLib.Error once bluez
+    replied. Keyword arguments are the RSSI_OPTIONS
+    """
+
+    manager = ObjectManager(root)
+    manager.add(
+        root + "/monitor0",
+        Monitor(patterns, found, lost, **kwargs),
+        "monitor.xml",
+    )
+    manager.register()
+
+    def registered(error):
+        if error:
+            manager.unregister()
+        else:
+            _LOGGER.info("Registered monitor for %d patterns", len(patterns))
+        done(error)
+
+    call_async(
+        adapter_path,
+        ADV_MONITOR_MANAGER_IFACE,
+        "RegisterMonitor",
+        "(o)",
+        (root,),
+        registered,
+    )
+
+    return manager
+
+
+def unregister_monitor(adapter_path, manager):
+    """Undo register_monitor, manager is the ObjectManager it returned"""
+    try:
+        proxy_for(adapter_path).UnregisterMonitor(manager.path)
+        _LOGGER.info("Unregistered monitor")
+    except GLib.Error as e:
+        _LOGGER.warning("Could not unregister monitor: %s", e)
+    manager.unregister()
@@ -13,6 +13,7 @@ import asyncio
 import certifi
 
 from . import DeviceObserver, DeviceManager
+from .pipeline import Pipeline, PipelineObserver
 from .util import quality_from_dbm
 
 _LOGGER = logging.getLogger(__name__)
@@ -57,9 +58,17 @@ def topic_for_path(path):
     return "/".join(["blus", platform.node(), path.split("/")[-1]])
 
 
-async def run(config=None):
+def encode(kind, path, device):
+    """(topic, payload) for a seen or unseen device"""
+    if kind == "unseen":
+        return topic_for_path(path), None
+    if "RSSI" in device:
+        device["_quality"] = quality_from_dbm(device["RSSI"])
+    return topic_for_path(path), json.dumps(device)
 
-    loop = asyncio.get_event_loop()
+
+def create_client(name="blus"):
+    """hbmqtt client, imported on demand"""
 
     try:
         import websockets
@@ -73,26 +82,69 @@ async def run(config=None):
             websockets.exceptions.InvalidHandshake
         )
 
-    from hbmqtt.client import MQTTClient, ConnectException, ClientException
+    from hbmqtt.client import MQTTClient
 
     logging.getLogger("hbmqtt.client.plugins.packet_logger_plugin").setLevel(
         logging.WARNING
     )
 
-    client_id = "blus_{hostname}_{time}".format(
-        hostname=platform.node(), time=time.time()
+    client_id = "{name}_{hostname}_{time}".format(
+        name=name, hostname=platform.node(), time=time.time()
     )
 
-    mqtt = MQTTClient(client_id=client_id)
+    return MQTTClient(client_id=client_id)
+
+
+async def connect(mqtt):
+    """Connect using credentials from mosquitto_pub. True if connected"""
+
+    from hbmqtt.client import ConnectException
+
+    _LOGGER.debug("Using MQTT url from mosquitto_pub")
+    mqtt_config = read_mqtt_config()
+    try:
+        username = mqtt_config["username"]
+        password = mqtt_config["password"]
+        host = mqtt_config["host"]
+        port = mqtt_config["port"]
+        url = "mqtts://{username}:{password}@{host}:{port}".format(
+            username=username, password=password, host=host, port=port
+        )
+
+        await mqtt.connect(url, cleansession=False, cafile=certifi.where())
+        _LOGGER.info("Connected to MQTT server")
+        return True
+    except ConnectException as e:
+        _LOGGER.error("Could not connect to MQTT server: %s", e)
+    except Exception as e:
+        _LOGGER.error("Could not read credentials: %s", e)
+    return False
+
+
+async def run(
+    config=None,
+    profiler=None,
+    schedule=None,
+    patterns=None,
+    monitor_options=None,
+    workers=0,
+):
+
+    loop = asyncio.get_event_loop()
+
+    from hbmqtt.client import ClientException
 
-    def publish(path, payload):
-        topic = topic_for_path(path)
+    mqtt = create_client()
+
+    def publish(topic, payload):
         _LOGGER.debug("Publishing on %s: %s", topic, payload)
 
         async def publish_task():
             try:
                 await mqtt.publish(
-                    topic, payload.encode("utf-8"), retain=False
+                    topic,
+                    payload.encode("utf-8") if payload else b"",
+                    retain=False,
                 )
             except Exception as e:
                 _LOGGER.error("Failed to publish: %s", e)
@@ -103,14 +155,11 @@ async def run(config=None):
         def async_seen(self, manager, path, device):
             assert is_mainthread()
             _LOGGER.debug("async seen %s", path)
-            if "RSSI" in device:
-                device["_quality"] = quality_from_dbm(device["RSSI"])
-            payload = json.dumps(device)
-            publish(path, payload)
+            publish(*encode("seen", path, device))
 
         def async_unseen(self, manager, path):
             _LOGGER.debug("async unseen %s", path)
-            publish(path, None)
+            publish(*encode("unseen", path, None))
 
         def seen(self, manager, path, device):
             assert not is_mainthread()
@@ -120,38 +169,62 @@ async def run(config=None):
             assert not is_mainthread()
             loop.call_soon_threadsafe(self.async_unseen, manager, path)
 
+    def publish_all(publications):
+        for topic, payload in publications:
+            publish(topic, payload)
+
     async def scanner_task():
+        managers = []
+        stopping = threading.Event()
+
         def scanner_thread():
             assert not is_mainthread()
             try:
                 _LOGGER.debug("scanner started")
-                DeviceManager(Observer()).scan()
+                manager = DeviceManager(
+                    PipelineObserver(pipeline) if pipeline else Observer()
+                )
+                managers.append(manager)
+                if profiler:
+                    profiler.track(manager)
+                if not stopping.is_set():
+                    manager.scan(
+                        schedule=schedule,
+                        patterns=patterns,
+                        monitor_options=monitor_options,
+                    )
             finally:
+                if pipeline:
+                    # only this thread puts records, so the pipeline is
+                    # stopped here, once the scanner is done
+                    pipeline.stop()
                 _LOGGER.debug("scanner thread kthxbye")
 
+        pipeline = None
+        if workers:
+            # encode in worker processes, publish from this loop
+            pipeline = Pipeline(
+                encode,
+                lambda publications: loop.call_soon_threadsafe(
+                    publish_all, publications
+                ),
+                workers,
+            )
+            pipeline.start()
+
+        scanner = loop.run_in_executor(None, scanner_thread)
         try:
-            await loop.run_in_executor(None, scanner_thread)
+            await asyncio.shield(scanner)
         finally:
+            stopping.set()
+            for manager in managers:
+                manager.stop()
+            if not scanner.done():
+                # wait for the scanner thread and the pipeline to stop
+                await scanner
             _LOGGER.info("Scanner task: kthxbye")
 
-    _LOGGER.debug("Using MQTT url from mosquitto_pub")
-    mqtt_config = read_mqtt_config()
-    try:
-        username = mqtt_config["username"]
-        password = mqtt_config["password"]
-        host = mqtt_config["host"]
-        port = mqtt_config["port"]
-        url = "mqtts://{username}:{password}@{host}:{port}".format(
-            username=username, password=password, host=host, port=port
-        )
-
-        await mqtt.connect(url, cleansession=False, cafile=certifi.where())
-        _LOGGER.info("Connected to MQTT server")
-    except ConnectException as e:
-        _LOGGER.error("Could not connect to MQTT server: %s", e)
-        return
-    except Exception as e:
-        _LOGGER.error("Could not read credentials: %s", e)
+    if not await connect(mqtt):
         return
 
     async def mqtt_task():
@@ -0,0 +1,119 @@
+# -*- mode: python; coding: utf-8 -*-
+
+import csv
+import json
+import sys
+import time
+
+from .util import quality_from_dbm
+
+
+FORMATS = ("table", "jsonl", "csv")
+OUTPUT_BUFFER = 64 * 1024
+
+EVENT_FIELDS = ("time", "address", "alias", "rssi", "quality", "path")
+EVENT_TABLE = "{alias} {address} on {path} {quality} %\n"
+
+SUMMARY_FIELDS = (
+    "address",
+    "alias",
+    "count",
+    "rssi_min",
+    "rssi_max",
+    "rssi_avg",
+    "path",
+)
+SUMMARY_TABLE = (
+    "{address:17} {count:>6} {rssi_min:>4} {rssi_max:>4} {rssi_avg:>6} "
+    "{alias}\n"
+)
+
+
+def open_stdout(buffering=OUTPUT_BUFFER):
+    """Block buffered stdout. Caller is responsible for flushing"""
+    sys.stdout.flush()
+    return open(sys.stdout.fileno(), "w", buffering=buffering, closefd=False)
+
+
+class Writer:
+    """Write records (dicts with fields) as table, jsonl or csv"""
+
+    def __init__(self, out, fmt, fields, table):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown format: %s" % fmt)
+        self.out = out
+        self.fmt = fmt
+        self.table = table
+        self.csv = None
+        if fmt == "csv":
+            self.csv = csv.DictWriter(out, fields, lineterminator="\n")
+            self.csv.writeheader()
+
+    def write(self, record):
+        if self.csv:
+            self.csv.writerow(record)
+        elif self.fmt == "jsonl":
+            self.out.write(json.dumps(record))
+            self.out.write("\n")
+        else:
+            self.out.write(
+                self.table.format(
+                    **{
+                        key: "-" if value is None else str(value)
+                        for key, value in record.items()
+                    }
+                )
+            )
+
+    def flush(self):
+        self.out.flush()
+
+
+def event_record(path, device):
+    rssi = device.get("RSSI")
+    return dict(
+        time=round(time.time(), 3),
+        address=device.get("Address"),
+        alias=device.get("Alias", path),
+        rssi=rssi,
+        quality=quality_from_dbm(rssi),
+        path=path,
+    )
+
+
+class Summary:
+    """Per device count and min/max/avg RSSI, kept in memory"""
+
+    def __init__(self):
+        self.devices = {}
+
+    def add(self, path, device):
+        entry = self.devices.get(path)
+        if entry is None:
+            entry = self.devices[path] = [None, None, 0, 0, 0, None, None]
+        entry[0] = device.get("Address", entry[0])
+        entry[1] = device.get("Alias", entry[1])
+        entry[2] += 1
+        rssi = device.get("RSSI")
+        if rssi is not None:
+            entry[3] += 1
+            entry[4] += rssi
+            entry[5] = rssi if entry[5] is None else min(entry[5], rssi)
+            entry[6] = rssi if entry[6] is None else max(entry[6], rssi)
+
+    def records(self):
+        for path, entry in sorted(
+            self.devices.items(), key=lambda item: -item[1][2]
+        ):
+            address, alias, count, rssi_count, rssi_sum, lo, hi = entry
+            yield dict(
+                address=address,
+                alias=alias or path,
+                count=count,
+                rssi_min=lo,
+                rssi_max=hi,
+                rssi_avg=(
+                    round(rssi_sum / rssi_count, 1) if rssi_count else None
+                ),
+                path=path,
+            )
@@ -0,0 +1,298 @@
+# -*- mode: python; coding: utf-8 -*-
+
+import ctypes
+import logging
+import marshal
+import multiprocessing
+import os
+import struct
+import threading
+import time
+
+from . import DeviceObserver
+
+_LOGGER = logging.getLogger(__name__)
+
+
+DEFAULT_RING_SIZE = 16 * 1024 * 1024
+BATCH = 256
+
+LENGTH = struct.Struct("<I")
+STOP = b""
+
+# record: operation, length of path, path, then for
+# SEEN: marshalled changed properties (None for removed)
+# RSSI: only RSSI changed, its value
+# UNSEEN: nothing
+# REPLACE: marshalled properties, replacing those of the worker
+HEADER = struct.Struct("<BH")
+PATH_LENGTH = struct.Struct("<H")
+RSSI_VALUE = struct.Struct("<h")
+SEEN, RSSI, UNSEEN, REPLACE = range(4)
+OPERATIONS = [
+    bytes((operation,)) for operation in (SEEN, RSSI, UNSEEN, REPLACE)
+]
+
+
+class RingBuffer:
+    """
+    Length prefixed records in shared memory. One producer, any number
+    of consumer processes. put() never blocks, it drops the record if
+    the buffer is full.
+    """
+
+    def __init__(self, size=DEFAULT_RING_SIZE):
+        self.size = size
+        self.buffer = multiprocessing.RawArray(ctypes.c_ubyte, size)
+        self.head = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self.tail = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self.lock = multiprocessing.Lock()
+        self.items = multiprocessing.Semaphore(0)
+        self.view = memoryview(self.buffer).cast("B")
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["view"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.view = memoryview(self.buffer).cast("B")
+
+    def _write(self, position, data):
+        start = position % self.size
+        end = start + len(data)
+        if end <= self.size:
+            self.view[start:end] = data
+        else:
+            split = self.size - start
+            self.view[start:] = data[:split]
+            self.view[: end - self.size] = data[split:]
+
+    def _read(self, position, length):
+        start = position % self.size
+        end = start + length
+        if end <= self.size:
+            return bytes(self.view[start:end])
+        return bytes(self.view[start:]) + bytes(self.view[: end - self.size])
+
+    def put(self, record):
+        length = LENGTH.size + len(record)
+        head = self.head.value
+        if self.size - (head - self.tail.value) < length:
+            return False
+        self._write(head, LENGTH.pack(len(record)) + record)
+        self.head.value = head + length
+        self.items.release()
+        return True
+
+    def get_many(self, count=BATCH):
+        """Wait for at least one record, return up to count records"""
+        self.items.acquire()
+        n = 1
+        while n < count and self.items.acquire(False):
+            n += 1
+        records = []
+        with self.lock:
+            tail = self.tail.value
+            for _ in range(n):
+                (length,) = LENGTH.unpack(self._read(tail, LENGTH.size))
+                records.append(self._read(tail + LENGTH.size, length))
+                tail += LENGTH.size + length
+                if records[-1] == STOP:
+                    # leave the rest, including other stops, to others
+                    for _ in range(n - len(records)):
+                        self.items.release()
+                    break
+            self.tail.value = tail
+        return records
+
+
+def _path_field(path):
+    path = path.encode()
+    return PATH_LENGTH.pack(len(path)) + path
+
+
+def _apply(record, devices):
+    """(kind, path, device) after merging record into devices"""
+    operation, length = HEADER.unpack_from(record)
+    start = HEADER.size
+    body = start + length
+    path = record[start:body].decode()
+    if operation == UNSEEN:
+        devices.pop(path, None)
+        return "unseen", path, None
+    if operation == REPLACE:
+        device = devices[path] = marshal.loads(record[body:])
+    elif operation == RSSI:
+        device = devices.setdefault(path, {})
+        (device["RSSI"],) = RSSI_VALUE.unpack_from(record, body)
+    else:
+        device = devices.setdefault(path, {})
+        for key, value in marshal.loads(record[body:]).items():
+            if value is None:
+                device.pop(key, None)
+            else:
+                device[key] = value
+    # transform may modify its argument
+    return "seen", path, dict(device)
+
+
+def _worker(ring, transform, results):
+    devices = {}
+    while True:
+        batch = []
+        records = ring.get_many()
+        for record in records:
+            if record == STOP:
+                break
+            try:
+                result = transform(*_apply(record, devices))
+            except Exception:
+                _LOGGER.exception("Failed to process record")
+                continue
+            if result is not None:
+                batch.append(result)
+        if batch:
+            try:
+                results.put(marshal.dumps(batch))
+            except ValueError:
+                _LOGGER.exception("Results not marshallable")
+        if records[-1] == STOP:
+            return
+
+
+class Pipeline:
+    """
+    Offload work from the scanner loop to worker processes.
+
+    put() appends a record with the properties changed since the last
+    put for the same path to one of the shared memory ring buffers,
+    size bytes in total. Paths are spread over the workers, one ring
+    each, and a worker merges the changes into its own copy of the
+    device. The first record for a path, and the next one after a
+    record was dropped, carries all properties and replaces the copy.
+    Workers call transform(kind, path, device) on each record and sink
+    is called, in a thread of this process, with lists of the results
+    that were not None. Results must be marshallable. Records failing
+    in a worker are logged and skipped.
+
+    Only worth it on multi-core hosts. Records are still built on the
+    thread calling put() and sink runs on one thread, so throughput is
+    bounded by those, not linear in the number of workers.
+    """
+
+    def __init__(self, transform, sink, workers=None, size=DEFAULT_RING_SIZE):
+        self.transform = transform
+        self.sink = sink
+        self.workers = workers or os.cpu_count()
+        self.rings = [
+            RingBuffer(size // self.workers) for _ in range(self.workers)
+        ]
+        self.results = multiprocessing.Queue()
+        self.processes = []
+        self.collector = None
+        self.sent = {}
+        self.dropped = 0
+
+    def start(self):
+        self.processes = [
+            multiprocessing.Process(
+                target=_worker,
+                args=(ring, self.transform, self.results),
+                name="blus-worker-%d" % i,
+                daemon=True,
+            )
+            for i, ring in enumerate(self.rings)
+        ]
+        for process in self.processes:
+            process.start()
+        self.collector = threading.Thread(
+            target=self._collect, name="pipeline", daemon=True
+        )
+        self.collector.start()
+        _LOGGER.info("Pipeline started with %d workers", self.workers)
+
+    def _collect(self):
+        while True:
+            results = self.results.get()
+            if results is None:
+                return
+            try:
+                self.sink(marshal.loads(results))
+            except Exception:
+                _LOGGER.exception("Sink failed")
+
+    def put(self, kind, path, device, block=False):
+        """
+        False if the record was dropped since the buffer is full. With
+        block, wait for workers to make room instead (e.g. for replay)
+        """
+        if kind == "unseen":
+            self.sent.pop(path, None)
+            record = OPERATIONS[UNSEEN] + _path_field(path)
+        else:
+            record = self._changes(path, device)
+        ring = self.rings[hash(path) % self.workers]
+        while not ring.put(record):
+            if not block:
+                # the worker missed these changes, replace next time
+                self.sent.pop(path, None)
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    _LOGGER.warning("Pipeline full, dropped %d", self.dropped)
+                return False
+            time.sleep(0.001)
+        return True
+
+    def _changes(self, path, device):
+        """record with properties changed since last put for path"""
+        entry = self.sent.get(path)
+        if entry is None:
+            # first put, or changes were dropped, the worker starts over
+            path_field = _path_field(path)
+            self.sent[path] = device.copy(), path_field
+            return OPERATIONS[REPLACE] + path_field + marshal.dumps(device)
+
+        sent, path_field = entry
+        self.sent[path] = device.copy(), path_field
+        # bluez replaces changed values, unchanged ones keep identity
+        previous = sent.get
+        changed = {
+            key: value
+            for key, value in device.items()
+            if previous(key) is not value
+        }
+        if sent.keys() != device.keys():
+            changed.update(dict.fromkeys(sent.keys() - device.keys()))
+        elif len(changed) == 1 and "RSSI" in changed:
+            return (
+                OPERATIONS[RSSI]
+                + path_field
+                + RSSI_VALUE.pack(changed["RSSI"])
+            )
+        return OPERATIONS[SEEN] + path_field + marshal.dumps(changed)
+
+    def stop(self):
+        """Call from the thread calling put, once it stopped doing so"""
+        for ring in self.rings:
+            while not ring.put(STOP):
+                time.sleep(0.01)
+        for process in self.processes:
+            process.join()
+        self.results.put(None)
+        self.collector.join()
+        _LOGGER.info("Pipeline stopped, dropped %d", self.dropped)
+
+
+class PipelineObserver(DeviceObserver):
+    """Feed seen and unseen events to a Pipeline"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def seen(self, manager, path, device):
+        self.pipeline.put("seen", path, device)
+
+    def unseen(self, manager, path):
+        self.pipeline.put("unseen", path, None)
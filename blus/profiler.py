@@ -0,0 +1,208 @@
+# -*- mode: python; coding: utf-8 -*-
+
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+_LOGGER = logging.getLogger(__name__)
+
+
+SAMPLE_INTERVAL = 0.02
+TRACEMALLOC_FRAMES = 1
+TOP = 25
+
+# (file, function) of leaf frames where a thread is blocked waiting
+IDLE = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("GLib.py", "run"),
+}
+
+
+class Profiler:
+    """
+    Low overhead profiler for a running scanner or gateway
+
+    A background thread samples the stacks of all other threads,
+    skipping threads idle in a main loop, selector or queue. A snapshot
+    is written to directory when the process receives signum (e.g. kill
+    -USR1 <pid>) and, if interval is given, every interval seconds.
+
+    tracemalloc slows down allocation heavy code considerably, so it is
+    only started by the first snapshot (one frame deep, the cheapest
+    mode) and allocation growth is reported from the second one on.
+    """
+
+    def __init__(
+        self,
+        directory=".",
+        interval=None,
+        sample_interval=SAMPLE_INTERVAL,
+        signum=signal.SIGUSR1,
+    ):
+        self.directory = directory
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.signum = signum
+        self.managers = []
+        self.own_samples = Counter()
+        self.total_samples = Counter()
+        self.thread_samples = Counter()
+        self.idle_samples = Counter()
+        self.sample_count = 0
+        self.previous = None
+        self.sequence = 0
+        self.requested = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def track(self, manager):
+        """include size of DeviceManager objects in snapshots"""
+        self.managers.append(manager)
+
+    def start(self):
+        signal.signal(self.signum, lambda *_: self.requested.set())
+        self.thread = threading.Thread(
+            target=self._run, name="profiler", daemon=True
+        )
+        self.thread.start()
+        _LOGGER.info(
+            "Profiling. Send signal %d to pid %d for a snapshot in %s",
+            self.signum,
+            os.getpid(),
+            os.path.abspath(self.directory),
+        )
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.snapshot()
+        if self.previous:
+            tracemalloc.stop()
+        signal.signal(self.signum, signal.SIG_DFL)
+
+    def _run(self):
+        deadline = self.interval and time.monotonic() + self.interval
+        while not self.stopped.wait(self.sample_interval):
+            self._sample()
+            if deadline and time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.interval
+                self.requested.set()
+            if self.requested.is_set():
+                self.requested.clear()
+                self.snapshot()
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        self.sample_count += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            name = names.get(ident, ident)
+            self.thread_samples[name] += 1
+            if _is_idle(frame):
+                self.idle_samples[name] += 1
+                continue
+            self.own_samples[_location(frame)] += 1
+            seen = set()
+            while frame:
+                location = _function(frame)
+                if location not in seen:
+                    seen.add(location)
+                    self.total_samples[location] += 1
+                frame = frame.f_back
+
+    def snapshot(self):
+        """write samples since last snapshot and allocation growth"""
+        self.sequence += 1
+        fname = os.path.join(
+            self.directory,
+            "blus-profile-%d-%04d.txt" % (os.getpid(), self.sequence),
+        )
+
+        if self.previous:
+            current = _take_snapshot()
+            growth = current.compare_to(self.previous, "lineno")
+            self.previous = current
+        else:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.previous = _take_snapshot()
+            growth = None
+
+        own_samples, self.own_samples = self.own_samples, Counter()
+        total_samples, self.total_samples = self.total_samples, Counter()
+        thread_samples, self.thread_samples = self.thread_samples, Counter()
+        idle_samples, self.idle_samples = self.idle_samples, Counter()
+        sample_count, self.sample_count = self.sample_count, 0
+
+        try:
+            with open(fname, "w") as f:
+                print(time.strftime("%Y-%m-%d %H:%M:%S"), file=f)
+                for manager in self.managers:
+                    print(
+                        "DeviceManager objects: %d, last seen: %d"
+                        % (len(manager.objects), len(manager.last_seen)),
+                        file=f,
+                    )
+                if growth is not None:
+                    size, peak = tracemalloc.get_traced_memory()
+                    print(
+                        "Traced memory: %d kB (peak %d kB)"
+                        % (size // 1024, peak // 1024),
+                        file=f,
+                    )
+
+                print("\nSamples: %d" % sample_count, file=f)
+                print("\nThreads (busy/sampled):", file=f)
+                for name, count in thread_samples.most_common():
+                    busy = count - idle_samples[name]
+                    print("%8d/%d %s" % (busy, count, name), file=f)
+                print("\nTop lines (own samples):", file=f)
+                for location, count in own_samples.most_common(TOP):
+                    print("%8d %s:%d %s" % (count, *location), file=f)
+                print("\nTop functions (total samples):", file=f)
+                for location, count in total_samples.most_common(TOP):
+                    print("%8d %s:%d %s" % (count, *location), file=f)
+
+                if growth is None:
+                    print(
+                        "\nAllocation tracing started, "
+                        "growth is reported in the next snapshot",
+                        file=f,
+                    )
+                else:
+                    print("\nAllocation growth by line:", file=f)
+                    for stat in growth[:TOP]:
+                        print(stat, file=f)
+            _LOGGER.info("Wrote profile snapshot to %s", fname)
+        except OSError as e:
+            _LOGGER.error("Could not write profile snapshot: %s", e)
+
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+
+
+def _is_idle(frame):
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE
+
+
+def _location(frame):
+    code = frame.f_code
+    return code.co_filename, frame.f_lineno, code.co_name
+
+
+def _function(frame):
+    code = frame.f_code
+    return code.co_filename, code.co_firstlineno, code.co_name
@@ -1,9 +1,11 @@
 import logging
+import pathlib
 import subprocess
 
 import pydbus
+from gi.repository import GLib
 
-from .const import ROOT_PATH, BUS_NAME
+from .const import ROOT_PATH, BUS_NAME, OBJECT_MANAGER_IFACE
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -57,3 +59,80 @@ def get_remote_objects():
     """
     _LOGGER.debug("Getting all known remote objects (only needed once)")
     return get_object_manager().GetManagedObjects()
+
+
+def read_introspection(name):
+    """D-Bus introspection xml shipped with the package"""
+    return pathlib.Path(__file__).with_name(name).read_text()
+
+
+def call_async(path, interface, method, signature, args, callback):
+    """
+    Call bluez method without blocking the main loop. Needed for methods
+    (e.g. RegisterApplication) where bluez calls back into objects we
+    export before replying. callback is called with None or GLib.Error
+    """
+
+    def reply(connection, result, *_user_data):
+        try:
+            connection.call_finish(result)
+        except GLib.Error as e:
+            _LOGGER.error("%s.%s failed: %s", interface, method, e)
+            callback(e)
+        else:
+            callback(None)
+
+    pydbus.SystemBus().con.call(
+        BUS_NAME,
+        path,
+        interface,
+        method,
+        GLib.Variant(signature, args),
+        None,
+        0,
+        -1,
+        None,
+        reply,
+        None,
+    )
+
+
+class ObjectManager:
+    """
+    Root of a tree of objects we export to bluez (monitors, GATT
+    services). Each managed object implements properties() returning
+    {interface: {name: Variant}}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = {}
+        self.registrations = []
+
+    def add(self, path, obj, introspection):
+        self.objects[path] = (obj, introspection)
+
+    def GetManagedObjects(self):
+        return {
+            path: obj.properties() for path, (obj, _) in self.objects.items()
+        }
+
+    def register(self):
+        bus = pydbus.SystemBus()
+        self.registrations.append(
+            bus.register_object(
+                self.path, self, read_introspection("object_manager.xml")
+            )
+        )
+        for path, (obj, introspection) in self.objects.items():
+            self.registrations.append(
+                bus.register_object(
+                    path, obj, read_introspection(introspection)
+                )
+            )
+        _LOGGER.debug("Registered %s at %s", OBJECT_MANAGER_IFACE, self.path)
+
+    def unregister(self):
+        for registration in self.registrations:
+            registration.unregister()
+        self.registrations = []
@@ -1,2 +1,979 @@
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import pydbus
+import pytest
+from gi.repository import GLib
+
+from blus import DeviceManager, DeviceObserver, DiscoverySchedule
+from blus import aggregate, monitor
+from blus.aggregate import Aggregator
+from blus.cache import GattCache, DATABASE_HASH_UUID
+from blus.const import (
+    ADAPTER_IFACE,
+    ADV_MONITOR_IFACE,
+    ADV_MONITOR_MANAGER_IFACE,
+    BUS_NAME,
+    CHARACTERISTIC_IFACE,
+    DEVICE_IFACE,
+    OBJECT_MANAGER_IFACE,
+    SERVICE_IFACE,
+)
+from blus.gatt import (
+    ADVERTISEMENT_PATH,
+    GATT_ROOT,
+    Characteristic,
+    Notifier,
+    unregister_advertisement,
+    unregister_application,
+)
+from blus.monitor import Pattern, parse_patterns
+from blus.output import Summary, Writer, EVENT_FIELDS, EVENT_TABLE
+from blus.pipeline import Pipeline, RingBuffer, _apply
+from blus.profiler import Profiler, _is_idle
+
+
 def test_dummy():
     pass
+
+
+def test_summary():
+    summary = Summary()
+    summary.add("/dev_a", dict(Address="A", RSSI=-60))
+    summary.add("/dev_a", dict(Address="A", Alias="Foo", RSSI=-80))
+    summary.add("/dev_b", dict(Address="B"))
+    a, b = summary.records()
+    assert a == dict(
+        address="A",
+        alias="Foo",
+        count=2,
+        rssi_min=-80,
+        rssi_max=-60,
+        rssi_avg=-70,
+        path="/dev_a",
+    )
+    assert b["count"] == 1 and b["rssi_avg"] is None
+
+
+def test_writer():
+    record = dict(
+        time=1, address="A", alias="Foo", rssi=-60, quality=80, path="/dev_a"
+    )
+    for fmt, expected in (
+        ("table", "Foo A on /dev_a 80 %\n"),
+        (
+            "jsonl",
+            '{"time": 1, "address": "A", "alias": "Foo", '
+            '"rssi": -60, "quality": 80, "path": "/dev_a"}\n',
+        ),
+        (
+            "csv",
+            "time,address,alias,rssi,quality,path\n1,A,Foo,-60,80,/dev_a\n",
+        ),
+    ):
+        out = io.StringIO()
+        Writer(out, fmt, EVENT_FIELDS, EVENT_TABLE).write(record)
+        assert out.getvalue() == expected
+
+
+def test_profiler_snapshot(tmp_path):
+    class Manager:
+        objects = dict(a=1, b=2)
+        last_seen = dict(a=1)
+
+    idle = threading.Event()
+    waiter = threading.Thread(target=idle.wait, name="waiter")
+    waiter.start()
+    while not _is_idle(sys._current_frames()[waiter.ident]):
+        time.sleep(0.001)
+
+    profiler = Profiler(directory=str(tmp_path))
+    profiler.track(Manager())
+    profiler._sample()
+    assert profiler.idle_samples["waiter"] == 1
+    assert not any(name == "wait" for _, _, name in profiler.own_samples)
+    idle.set()
+    waiter.join()
+
+    profiler.snapshot()
+    assert tracemalloc.is_tracing()
+    profiler.snapshot()
+    tracemalloc.stop()
+
+    first, second = sorted(tmp_path.iterdir())
+    first, second = first.read_text(), second.read_text()
+    assert "DeviceManager objects: 2, last seen: 1" in first
+    assert "0/1 waiter" in first
+    assert "Allocation tracing started" in first
+    assert "Allocation growth by line" in second
+
+
+def test_aggregator():
+    aggregator = Aggregator(
+        smoothing=0.5,
+        hysteresis=6,
+        rate_limit=datetime.timedelta(seconds=10),
+    )
+
+    published = []
+
+    def gateway(node, rssi, now):
+        # in-process stand-in for the broker delivering a gateway message
+        payload = json.dumps(dict(Address="AA:BB", RSSI=rssi))
+        publication = aggregator.handle(
+            "blus/%s/dev_AA_BB" % node, payload, now
+        )
+        if publication:
+            published.append(publication)
+
+    gateway("kitchen", -70, now=0)
+    gateway("hall", -68, now=1)  # within hysteresis, rate limited
+    gateway("hall", -56, now=2)  # smoothed -62, beats kitchen by 8
+    gateway("hall", -56, now=3)  # smoothed -59, rate limited
+    gateway("kitchen", -70, now=4)  # rate limited
+    gateway("kitchen", -70, now=14)
+
+    assert len(aggregator.devices) == 1
+    assert [json.loads(payload)["_node"] for _, payload in published] == [
+        "kitchen",
+        "hall",
+        "hall",
+    ]
+    topic, payload = published[-1]
+    assert topic == "blus_aggregate/dev_AA_BB"
+    assert json.loads(payload)["RSSI"] == -59
+
+    assert aggregator.handle("blus/hall/dev_AA_BB", "", now=15)[1]
+    assert aggregator.handle("blus/kitchen/dev_AA_BB", "", now=16) == (
+        "blus_aggregate/dev_AA_BB",
+        None,
+    )
+    assert not aggregator.devices
+
+
+class FakeClient:
+    """connected MQTTClient stand-in delivering queued messages"""
+
+    def __init__(self):
+        self.messages = asyncio.Queue()
+        self.subscriptions = []
+        self.published = []
+        self.disconnected = False
+
+    def deliver(self, topic, data):
+        self.messages.put_nowait(
+            SimpleNamespace(
+                publish_packet=SimpleNamespace(
+                    variable_header=SimpleNamespace(topic_name=topic),
+                    payload=SimpleNamespace(data=data),
+                )
+            )
+        )
+
+    async def subscribe(self, topics):
+        self.subscriptions.extend(topics)
+
+    async def deliver_message(self):
+        return await self.messages.get()
+
+    async def publish(self, topic, payload, retain=False):
+        self.published.append((topic, payload))
+
+    async def disconnect(self):
+        self.disconnected = True
+
+
+def test_aggregate_run():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = FakeClient()
+    aggregator = Aggregator(node_timeout=datetime.timedelta(seconds=0.2))
+
+    async def until(condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError("timed out")
+
+    async def scenario():
+        task = loop.create_task(aggregate.run(aggregator, client))
+        await until(lambda: client.subscriptions)
+        assert client.subscriptions == [(aggregate.GATEWAY_TOPIC, 0)]
+
+        # malformed messages are dropped without ending the task
+        for data in (b"\xff\xfe", b"1", b"[1, 2]", b'"x"', b"{"):
+            client.deliver("blus/hall/dev_AA_BB", data)
+        client.deliver("blus/hall", b"{}")
+        client.deliver("blus/hall/dev_AA_BB", b'{"RSSI": -60}')
+        await until(lambda: client.published)
+        topic, payload = client.published[0]
+        assert topic == "blus_aggregate/dev_AA_BB"
+        assert json.loads(payload.decode("utf-8"))["_node"] == "hall"
+
+        # the hall node goes silent and the device expires
+        await until(lambda: len(client.published) == 2)
+        assert client.published[1] == ("blus_aggregate/dev_AA_BB", b"")
+        assert not aggregator.devices
+        assert not task.done()
+
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert client.disconnected
+
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_discovery_schedule():
+    schedule = DiscoverySchedule(
+        window=datetime.timedelta(seconds=10),
+        pause=datetime.timedelta(seconds=20),
+        factor=2,
+        max_factor=4,
+    )
+    assert schedule.adapt(new_devices=3) == (20, 10)
+    assert schedule.adapt(new_devices=1) == (40, 5)
+    assert schedule.adapt(new_devices=1) == (40, 5)
+    assert schedule.adapt(new_devices=0) == (20, 10)
+    assert schedule.adapt(new_devices=0) == (10, 20)
+    assert schedule.adapt(new_devices=0) == (10, 20)
+
+
+ADAPTER = "/org/bluez/hci0"
+DEVICE = ADAPTER + "/dev_AA_BB"
+
+
+class FakeAdapter:
+    Name = "hci0"
+    Address = "00:11:22:33:44:55"
+    Powered = True
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, method):
+        return lambda *args: self.calls.append((method, *args))
+
+
+class Recorder(DeviceObserver):
+    def __init__(self):
+        self.events = []
+
+    def discovered(self, manager, path, device):
+        self.events.append(("discovered", path))
+
+    def seen(self, manager, path, device):
+        self.events.append(("seen", path))
+
+    def unseen(self, manager, path):
+        self.events.append(("unseen", path))
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    """DeviceManager on a known adapter and device, without bluez"""
+    objects = {
+        ADAPTER: {ADAPTER_IFACE: dict(Address=FakeAdapter.Address)},
+        DEVICE: {
+            DEVICE_IFACE: dict(
+                Address="AA:BB", AddressType="random", Paired=False
+            )
+        },
+    }
+    adapter = FakeAdapter()
+    monkeypatch.setattr("blus.device.get_remote_objects", lambda: objects)
+    monkeypatch.setattr("blus.device.bluez_version", lambda: (5, 64))
+    monkeypatch.setattr("blus.device.proxy_for", lambda path: adapter)
+    with monkeypatch.context() as patch:
+        # no periodic purge
+        patch.setattr("blus.device.GLib.idle_add", lambda *args: None)
+        return DeviceManager(Recorder())
+
+
+def test_new_devices(manager):
+    other = ADAPTER + "/dev_CC_DD"
+    for _ in range(3):
+        # temporary devices are re-added after bluez removed them
+        manager._interfaces_added(other, {DEVICE_IFACE: dict(Address="CC")})
+        manager._interfaces_removed(other, [DEVICE_IFACE])
+    manager._interfaces_removed(DEVICE, [DEVICE_IFACE])
+    manager._interfaces_added(DEVICE, {DEVICE_IFACE: dict(Address="AA:BB")})
+    assert manager.new_devices == 1
+    assert manager.observer.events.count(("discovered", other)) == 3
+
+
+def test_listening_time(manager):
+    observer, adapter = manager.observer, manager.adapter
+    manager.discover_device(DEVICE)
+
+    # seen just before a pause longer than the purge timeout
+    manager.pause_discovery()
+    manager.deaf_since -= 600
+    manager.last_seen[DEVICE] -= 600
+    assert 600 <= time.time() - manager.listening_time() < 601
+
+    manager.see_device(DEVICE)
+    manager.purge_unseen_devices()
+    assert observer.events == [("discovered", DEVICE)]  # throttled
+    assert ("RemoveDevice", DEVICE) not in adapter.calls
+
+    manager.start_discovery()
+    assert manager.deaf_since is None
+    assert 600 <= manager.deaf_time < 601
+
+    manager.last_seen[DEVICE] -= 11
+    manager.see_device(DEVICE)
+    assert observer.events[-1] == ("seen", DEVICE)
+
+    manager.last_seen[DEVICE] -= 301
+    manager.purge_unseen_devices()
+    assert ("RemoveDevice", DEVICE) in adapter.calls
+
+
+def test_monitor_found_lost(manager):
+    other = ADAPTER + "/dev_CC_DD"
+    manager.monitored = set()
+    manager._interfaces_added(other, {DEVICE_IFACE: dict(Address="CC")})
+    manager.see_device(DEVICE)
+    assert manager.observer.events == []
+
+    manager.device_found(DEVICE)
+    manager.device_lost(DEVICE)
+    manager.see_device(DEVICE)
+    assert manager.observer.events == [
+        ("discovered", DEVICE),
+        ("unseen", DEVICE),
+    ]
+
+
+@contextlib.contextmanager
+def _subscription(*args, **kwargs):
+    yield
+
+
+def stub_bus(monkeypatch):
+    """no signal subscriptions for DeviceManager.scan"""
+    signal = SimpleNamespace(connect=_subscription)
+    bus = SimpleNamespace(subscribe=_subscription)
+    object_manager = SimpleNamespace(
+        InterfacesAdded=signal, InterfacesRemoved=signal
+    )
+    monkeypatch.setattr("blus.device.pydbus.SystemBus", lambda: bus)
+    monkeypatch.setattr(
+        "blus.device.get_object_manager", lambda: object_manager
+    )
+
+
+def scan_with_monitor(manager, monkeypatch, error):
+    """scan with patterns against stubbed bus and monitor registration"""
+    stub_bus(monkeypatch)
+
+    registered = []
+    unregistered = []
+
+    def register_monitor(adapter_path, patterns, found, lost, done, **kw):
+        registered.append(kw)
+        GLib.idle_add(done, error)
+        GLib.timeout_add(50, manager.stop)
+        return "objects"
+
+    monkeypatch.setattr("blus.monitor.register_monitor", register_monitor)
+    monkeypatch.setattr(
+        "blus.monitor.unregister_monitor",
+        lambda adapter_path, objects: unregistered.append(objects),
+    )
+
+    manager.objects[ADAPTER][ADV_MONITOR_MANAGER_IFACE] = dict(
+        SupportedMonitorTypes=["or_patterns"]
+    )
+    manager.scan(
+        patterns=[monitor.Pattern(0xFF, 0, b"\x4c")],
+        monitor_options=dict(rssi_high_threshold=-60),
+    )
+    assert registered == [dict(rssi_high_threshold=-60)]
+    return unregistered
+
+
+def test_monitor_scan(manager, monkeypatch):
+    assert scan_with_monitor(manager, monkeypatch, None) == ["objects"]
+    assert manager.monitor_objects is None
+    assert manager.monitored == set()
+    assert manager.observer.events == []
+    assert ("StartDiscovery",) not in manager.adapter.calls
+
+
+def test_monitor_fallback(manager, monkeypatch):
+    error = GLib.Error("org.bluez.Error.Failed")
+    assert scan_with_monitor(manager, monkeypatch, error) == []
+    assert manager.monitored is None
+    assert manager.observer.events == [("discovered", DEVICE)]
+    assert ("StartDiscovery",) in manager.adapter.calls
+
+
+@pytest.fixture(scope="module")
+def system_bus():
+    """private dbus-daemon as the system bus of pydbus.SystemBus()"""
+    daemon = shutil.which("dbus-daemon")
+    if not daemon:
+        pytest.skip("dbus-daemon not installed")
+    process = subprocess.Popen(
+        [daemon, "--session", "--nofork", "--print-address"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    address = process.stdout.readline().strip()
+    previous = os.environ.get("DBUS_SYSTEM_BUS_ADDRESS")
+    os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = address
+    try:
+        bus = pydbus.SystemBus()
+        if "guid=" + bus.con.get_guid() not in address:
+            pytest.skip("system bus connected before the private bus")
+        bus.con.set_exit_on_close(False)
+        yield address
+    finally:
+        if previous is None:
+            del os.environ["DBUS_SYSTEM_BUS_ADDRESS"]
+        else:
+            os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = previous
+        process.terminate()
+        process.wait()
+
+
+FAKE_OBJECT_MANAGER = """
+<node>
+  <interface name="org.freedesktop.DBus.ObjectManager">
+    <method name="GetManagedObjects">
+      <arg type="a{oa{sa{sv}}}" name="objects" direction="out"/>
+    </method>
+    <signal name="InterfacesAdded">
+      <arg type="o" name="object"/>
+      <arg type="a{sa{sv}}" name="interfaces"/>
+    </signal>
+    <signal name="InterfacesRemoved">
+      <arg type="o" name="object"/>
+      <arg type="as" name="interfaces"/>
+    </signal>
+  </interface>
+</node>
+"""
+
+FAKE_MONITOR_MANAGER = """
+<node>
+  <interface name="org.bluez.AdvertisementMonitorManager1">
+    <method name="RegisterMonitor">
+      <arg type="o" name="application" direction="in"/>
+    </method>
+    <method name="UnregisterMonitor">
+      <arg type="o" name="application" direction="in"/>
+    </method>
+  </interface>
+</node>
+"""
+
+
+class FakeObjectManager:
+    InterfacesAdded = pydbus.generic.signal()
+    InterfacesRemoved = pydbus.generic.signal()
+
+    def GetManagedObjects(self):
+        return {}
+
+
+class Failed(Exception):
+    pass
+
+
+class FakeBluez(threading.Thread):
+    """
+    org.bluez on the private bus, with its own connection and main
+    context. Reads the properties of registered monitors and reports
+    DEVICE found and lost to them, or fails registration
+    """
+
+    def __init__(self, address):
+        super().__init__(daemon=True)
+        self.address = address
+        self.fail = False
+        self.calls = []
+        self.monitor = None
+        self.context = GLib.MainContext()
+        self.loop = GLib.MainLoop(self.context)
+        self.ready = threading.Event()
+
+    def run(self):
+        self.context.push_thread_default()
+        self.bus = pydbus.connect(self.address)
+        with self.bus.register_object(
+            "/", FakeObjectManager(), FAKE_OBJECT_MANAGER
+        ), self.bus.register_object(
+            ADAPTER, self, FAKE_MONITOR_MANAGER
+        ), self.bus.request_name(
+            BUS_NAME
+        ):
+            self.ready.set()
+            self.loop.run()
+        self.bus.con.close_sync(None)
+        self.context.pop_thread_default()
+
+    def RegisterMonitor(self, root, dbus_context):
+        self.calls.append(("RegisterMonitor", root))
+        if self.fail:
+            raise Failed("no monitor for you")
+        # like bluez, before replying
+        objects = self.bus.con.call_sync(
+            dbus_context.sender,
+            root,
+            OBJECT_MANAGER_IFACE,
+            "GetManagedObjects",
+            None,
+            None,
+            0,
+            -1,
+            None,
+        ).get_child_value(0)
+        (path,) = objects.keys()
+        properties = objects.lookup_value(path, None).lookup_value(
+            ADV_MONITOR_IFACE, None
+        )
+        self.monitor = {}
+        for name in properties.keys():
+            value = properties.lookup_value(name, None)
+            self.monitor[name] = (value.get_type_string(), value.unpack())
+
+        def report():
+            proxy = self.bus.get(dbus_context.sender, path)
+            proxy.Activate()
+            proxy.DeviceFound(DEVICE)
+            proxy.DeviceLost(DEVICE)
+            return False
+
+        source = GLib.idle_source_new()
+        source.set_callback(lambda *args: report())
+        source.attach(self.context)
+
+    def UnregisterMonitor(self, root):
+        self.calls.append(("UnregisterMonitor", root))
+
+
+@pytest.fixture
+def bluez(system_bus):
+    fake = FakeBluez(system_bus)
+    fake.start()
+    assert fake.ready.wait(5)
+    yield fake
+    fake.loop.quit()
+    fake.join(5)
+
+
+def scan_on_bus(manager, until):
+    """scan with patterns against the fake bluez until event observed"""
+    deadline = time.monotonic() + 5
+
+    def check():
+        if until in manager.observer.events or time.monotonic() > deadline:
+            manager.stop()
+            return False
+        return True
+
+    GLib.timeout_add(10, check)
+    manager.objects[ADAPTER][ADV_MONITOR_MANAGER_IFACE] = dict(
+        SupportedMonitorTypes=["or_patterns"]
+    )
+    manager.scan(
+        patterns=[monitor.Pattern(0xFF, 0, b"\x4c")],
+        monitor_options=dict(rssi_high_threshold=-60, rssi_high_timeout=5),
+    )
+
+
+def test_monitor_bus(manager, bluez):
+    scan_on_bus(manager, ("unseen", DEVICE))
+    root = monitor.MONITOR_ROOT
+    assert bluez.calls == [
+        ("RegisterMonitor", root),
+        ("UnregisterMonitor", root),
+    ]
+    assert bluez.monitor == dict(
+        Type=("s", "or_patterns"),
+        Patterns=("a(yyay)", [(0, 0xFF, [0x4C])]),
+        RSSIHighThreshold=("n", -60),
+        RSSIHighTimeout=("q", 5),
+    )
+    assert manager.observer.events == [
+        ("discovered", DEVICE),
+        ("unseen", DEVICE),
+    ]
+    assert manager.monitor_objects is None
+    assert ("StartDiscovery",) not in manager.adapter.calls
+
+
+def test_monitor_bus_fallback(manager, bluez):
+    bluez.fail = True
+    scan_on_bus(manager, ("discovered", DEVICE))
+    assert bluez.calls == [("RegisterMonitor", monitor.MONITOR_ROOT)]
+    assert manager.observer.events == [("discovered", DEVICE)]
+    assert manager.monitored is None
+    assert ("StartDiscovery",) in manager.adapter.calls
+
+
+def test_stop_before_scan(manager, monkeypatch):
+    stub_bus(monkeypatch)
+    manager.stop()
+    manager.scan()
+    assert ("StartDiscovery",) not in manager.adapter.calls
+
+
+def test_monitor_patterns():
+    assert parse_patterns("ff:0:4c00,16:2:AAFE") == [
+        Pattern(0xFF, 0, b"\x4c\x00"),
+        Pattern(0x16, 2, b"\xaa\xfe"),
+    ]
+
+
+def test_notifier():
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    notifier = Notifier(ours, mtu=10, coalesce=True)
+    for value in (b"abc", b"def", b"ghi"):
+        notifier.queue(value)
+    assert notifier.flush()
+    assert theirs.recv(100) == b"abcdef"
+    assert theirs.recv(100) == b"ghi"
+    notifier.close()
+    theirs.close()
+
+
+def test_notifier_drops_oldest():
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    notifier = Notifier(ours, mtu=10, max_pending=2)
+    for value in (b"abc", b"def", b"ghi"):
+        notifier.queue(value)
+    assert notifier.dropped == 1
+    assert notifier.flush()
+    assert theirs.recv(100) == b"def"
+    assert theirs.recv(100) == b"ghi"
+    notifier.close()
+    theirs.close()
+
+
+def test_characteristic_acquire():
+    characteristic = Characteristic("2a19", ["read", "notify"])
+    properties = characteristic.properties()[CHARACTERISTIC_IFACE]
+    assert "NotifyAcquired" in properties and "WriteAcquired" in properties
+    characteristic.acquire = False
+    properties = characteristic.properties()[CHARACTERISTIC_IFACE]
+    assert set(properties) == {"UUID", "Service", "Flags"}
+
+
+def test_characteristic_notify_loop():
+    characteristic = Characteristic("2a19", ["read", "notify"])
+    fd, mtu = characteristic.AcquireNotify(dict(mtu=10))
+    # bluez side, a copy as ours is closed once the reply was sent
+    theirs = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    theirs.setblocking(False)
+    assert mtu == 10 and characteristic.NotifyAcquired
+    # fills up quickly, so flushing continues when writable
+    characteristic.notifier.sock.setsockopt(
+        socket.SOL_SOCKET, socket.SO_SNDBUF, 1
+    )
+    values = [b"%03d" % i for i in range(50)]
+    for value in values:
+        characteristic.notify(value)
+
+    received = []
+    deadline = time.monotonic() + 5
+    loop = GLib.MainLoop()
+
+    def bluez():
+        if len(received) < len(values):
+            with contextlib.suppress(BlockingIOError):
+                while True:
+                    received.append(theirs.recv(100))
+            if len(received) == len(values):
+                theirs.close()
+        if characteristic.notifier is None or time.monotonic() > deadline:
+            loop.quit()
+            return False
+        return True
+
+    GLib.timeout_add(10, bluez)
+    loop.run()
+    assert received == values
+    assert characteristic.notifier is None
+    assert not characteristic.NotifyAcquired
+
+
+def test_unregister_gatt(monkeypatch):
+    adapter = FakeAdapter()
+    monkeypatch.setattr("blus.gatt.proxy_for", lambda path: adapter)
+    unregistered = []
+    exported = SimpleNamespace(
+        path=GATT_ROOT, unregister=lambda: unregistered.append(True)
+    )
+    unregister_application(ADAPTER, exported)
+    unregister_advertisement(ADAPTER, exported)
+    assert adapter.calls == [
+        ("UnregisterApplication", GATT_ROOT),
+        ("UnregisterAdvertisement", ADVERTISEMENT_PATH),
+    ]
+    assert unregistered == [True, True]
+
+
+def test_gatt_cache(tmp_path):
+    device = "/org/bluez/hci0/dev_AA"
+    service = device + "/service0001"
+
+    class Manager:
+        level = service + "/char0002"
+        db_hash = [1, 2]
+
+        def get_device(self, path):
+            return dict(Address="AA")
+
+        def services(self, device_path):
+            return [
+                (service, dict(UUID="0000180F-0000-1000-8000-00805F9B34FB"))
+            ]
+
+        def characteristics(self, service_path):
+            return [
+                (
+                    self.level,
+                    dict(UUID="00002a19-0000-1000-8000-00805f9b34fb"),
+                ),
+                (
+                    service + "/char0004",
+                    dict(UUID=DATABASE_HASH_UUID, Value=self.db_hash),
+                ),
+            ]
+
+    fname = str(tmp_path / "gatt.json")
+    GattCache(fname).update(Manager(), device)
+
+    cache = GattCache(fname)
+    uuid = "00002A19-0000-1000-8000-00805F9B34FB"
+    assert cache.characteristic("AA", uuid) == service + "/char0002"
+    assert cache.characteristic("AA", uuid, db_hash="0102")
+    assert not cache.characteristic("AA", uuid, db_hash="0103")
+    assert not cache.characteristic("BB", uuid)
+
+    # new firmware, both layouts are kept by hash
+    manager = Manager()
+    manager.level, manager.db_hash = service + "/char0006", [1, 3]
+    cache.update(manager, device)
+    cache = GattCache(fname)
+    assert cache.characteristic("AA", uuid, db_hash="0102").endswith("0002")
+    assert cache.characteristic("AA", uuid, db_hash="0103").endswith("0006")
+    assert not cache.characteristic("AA", uuid)  # hash not read yet
+
+    cache.invalidate("AA", "0103")
+    assert cache.characteristic("AA", uuid).endswith("0002")
+    cache.invalidate("AA")
+    assert not GattCache(fname).entries
+
+
+BATTERY_SERVICE = "0000180f-0000-1000-8000-00805f9b34fb"
+BATTERY_LEVEL = "00002a19-0000-1000-8000-00805f9b34fb"
+DEVICE_NAME = "00002a00-0000-1000-8000-00805f9b34fb"
+
+
+def add_services(manager, level_uuid=BATTERY_LEVEL, resolved=True):
+    service = DEVICE + "/service0001"
+    manager.objects[service] = {
+        SERVICE_IFACE: dict(UUID=BATTERY_SERVICE, Device=DEVICE)
+    }
+    manager.objects[service + "/char0002"] = {
+        CHARACTERISTIC_IFACE: dict(UUID=level_uuid, Service=service)
+    }
+    manager.objects[DEVICE][DEVICE_IFACE].update(
+        Connected=True, ServicesResolved=resolved
+    )
+    return service
+
+
+def remove_services(manager, service):
+    """disconnected, bluez removes the services"""
+    manager.objects[DEVICE][DEVICE_IFACE].update(
+        Connected=False, ServicesResolved=False
+    )
+    manager._interfaces_removed(service + "/char0002", [CHARACTERISTIC_IFACE])
+    manager._interfaces_removed(service, [SERVICE_IFACE])
+
+
+def test_gatt_cache_stale(manager, tmp_path):
+    fname = str(tmp_path / "gatt.json")
+    manager.gatt_cache = GattCache(fname)
+    service = add_services(manager)
+    level = service + "/char0002"
+    manager.gatt_cache.update(manager, DEVICE)
+
+    remove_services(manager, service)
+    assert manager.characteristic(DEVICE, BATTERY_LEVEL) is None
+
+    # reconnected, bluez exports its cached attributes before resolving
+    add_services(manager, resolved=False)
+    assert manager.characteristic(DEVICE, BATTERY_LEVEL) == level
+    assert GattCache(fname).lookup("AA:BB")
+
+    # reconnected to new firmware, the cached path is another attribute
+    remove_services(manager, service)
+    add_services(manager, level_uuid=DEVICE_NAME, resolved=False)
+    assert manager.characteristic(DEVICE, BATTERY_LEVEL) is None
+    assert not GattCache(fname).lookup("AA:BB")
+
+
+def test_gatt_cache_service_changed(manager, tmp_path):
+    manager.gatt_cache = GattCache(str(tmp_path / "gatt.json"))
+    service = add_services(manager)
+    manager.gatt_cache.update(manager, DEVICE)
+    assert manager.gatt_cache.lookup("AA:BB")
+
+    # services removed while connected and resolved
+    manager._interfaces_removed(service, [SERVICE_IFACE])
+    assert not manager.gatt_cache.lookup("AA:BB")
+
+
+def test_ring_buffer():
+    ring = RingBuffer(size=32)
+    for _ in range(5):
+        # wraps around the end of the buffer
+        assert ring.put(b"0123456789")
+        assert ring.put(b"abc")
+        assert not ring.put(b"0123456789abcdef")
+        assert ring.get_many() == [b"0123456789", b"abc"]
+
+
+def _double(kind, path, device):
+    return path, device["RSSI"] * 2
+
+
+def test_pipeline():
+    results = []
+    done = threading.Event()
+
+    def sink(batch):
+        results.extend(batch)
+        if len(results) == 100:
+            done.set()
+
+    pipeline = Pipeline(_double, sink, workers=2, size=1024)
+    pipeline.start()
+    for i in range(100):
+        pipeline.put("seen", "/dev_%d" % i, dict(RSSI=-i), block=True)
+    assert done.wait(10)
+    pipeline.stop()
+    assert sorted(results) == sorted(
+        ("/dev_%d" % i, -2 * i) for i in range(100)
+    )
+
+
+def _received(kind, path, device):
+    return kind, path, device
+
+
+def test_pipeline_changes():
+    results = []
+    done = threading.Event()
+
+    def sink(batch):
+        results.extend(batch)
+        if len(results) == 5:
+            done.set()
+
+    pipeline = Pipeline(_received, sink, workers=2, size=1024)
+    pipeline.start()
+    # updated in place like the objects of DeviceManager
+    device = dict(Address="AA", RSSI=-60, UUIDs=["180f"])
+    pipeline.put("seen", "/dev_a", device, block=True)
+    device["RSSI"] = -61
+    pipeline.put("seen", "/dev_a", device, block=True)
+    del device["UUIDs"]
+    pipeline.put("seen", "/dev_a", device, block=True)
+    del device["Address"]
+    device["TxPower"] = 4
+    pipeline.put("seen", "/dev_a", device, block=True)
+    pipeline.put("unseen", "/dev_a", None, block=True)
+    assert done.wait(10)
+    pipeline.stop()
+    assert results == [
+        ("seen", "/dev_a", dict(Address="AA", RSSI=-60, UUIDs=["180f"])),
+        ("seen", "/dev_a", dict(Address="AA", RSSI=-61, UUIDs=["180f"])),
+        ("seen", "/dev_a", dict(Address="AA", RSSI=-61)),
+        ("seen", "/dev_a", dict(RSSI=-61, TxPower=4)),
+        ("unseen", "/dev_a", None),
+    ]
+
+
+def test_pipeline_dropped(monkeypatch):
+    pipeline = Pipeline(_received, None, workers=1, size=1024)
+    ring = pipeline.rings[0]
+    devices = {}
+    device = dict(Address="AA", UUIDs=["180f"])
+    assert pipeline.put("seen", "/dev_a", device)
+    assert _apply(*ring.get_many(), devices) == ("seen", "/dev_a", device)
+
+    del device["UUIDs"]
+    with monkeypatch.context() as patch:
+        # full
+        patch.setattr(ring, "put", lambda record: False)
+        assert not pipeline.put("seen", "/dev_a", device)
+    assert pipeline.dropped == 1
+
+    # replaces the copy of the worker, which never saw UUIDs removed
+    device["RSSI"] = -60
+    assert pipeline.put("seen", "/dev_a", device)
+    assert _apply(*ring.get_many(), devices) == (
+        "seen",
+        "/dev_a",
+        dict(Address="AA", RSSI=-60),
+    )
+
+
+def _fail_on_b(kind, path, device):
+    if path == "/dev_b":
+        raise ValueError(path)
+    return path
+
+
+def test_pipeline_bad_records():
+    results = []
+    done = threading.Event()
+
+    def sink(batch):
+        results.extend(batch)
+        done.set()
+
+    pipeline = Pipeline(_fail_on_b, sink, workers=1, size=1024)
+    pipeline.start()
+    assert pipeline.rings[0].put(b"\x01")
+    pipeline.put("seen", "/dev_b", dict(RSSI=-60), block=True)
+    pipeline.put("seen", "/dev_a", dict(RSSI=-60), block=True)
+    assert done.wait(10)
+    pipeline.stop()
+    assert results == ["/dev_a"]
+
+
+def test_pipeline_record_size():
+    pipeline = Pipeline(_received, None, workers=1, size=1024)
+    device = dict(Address="AA", RSSI=-60, ManufacturerData={76: [1, 2, 3]})
+    assert len(pipeline._changes("/dev_a", device)) > 30
+    device["RSSI"] = -61
+    # header, path and value
+    assert len(pipeline._changes("/dev_a", device)) == 3 + 6 + 2